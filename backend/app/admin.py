@@ -0,0 +1,46 @@
+from typing import Any, Dict, List
+from fastapi import APIRouter, HTTPException, Query, Response
+from .maintenance import maintenance_status, run_maintenance
+from .profiler import profiler
+from .tracing import find_trace, recent_traces
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+@router.get("/traces")
+def list_traces(limit: int = Query(default=50, ge=1, le=1000)) -> List[Dict[str, Any]]:
+    return recent_traces(limit)
+
+@router.get("/traces/{trace_id}")
+def read_trace(trace_id: str) -> Dict[str, Any]:
+    trace = find_trace(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="trace not found")
+    return trace
+
+@router.post("/profile")
+def start_profile(
+    requests: int = Query(default=10, ge=1, le=10000),
+    interval_ms: float = Query(default=5.0, ge=0.5, le=1000.0),
+) -> Dict[str, Any]:
+    profiler.arm(requests, interval_ms / 1000.0)
+    return profiler.status()
+
+@router.get("/profile")
+def profile_status() -> Dict[str, Any]:
+    return profiler.status()
+
+@router.get("/profile/folded")
+def profile_folded() -> Response:
+    # Folded stacks for flamegraph.pl or speedscope.
+    return Response(profiler.folded(), media_type="text/plain")
+
+@router.get("/maintenance")
+def read_maintenance() -> Dict[str, Any]:
+    return maintenance_status()
+
+@router.post("/maintenance")
+def trigger_maintenance(full_vacuum: bool = False) -> Dict[str, Any]:
+    report = run_maintenance(full_vacuum)
+    if report is None:
+        raise HTTPException(status_code=409, detail="maintenance already running")
+    return report
@@ -1,27 +1,57 @@
 from typing import Any, Dict, List
 from fastapi import APIRouter, HTTPException
+from .config_cache import config_cache
+from .context import STRATEGIES
 from .db import api_config_row, db_session, dumps_json_obj, utc_now_iso
 from .schemas import ApiConfigCreate, ApiConfigUpdate, ApiConfigOut
+from .tracing import span
 
 router = APIRouter(prefix="/api-configs", tags=["api-configs"])
 
+def _check_context_strategy(strategy: str) -> None:
+    if strategy not in STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"unknown context_strategy: {strategy}")
+
+def _load_api_configs() -> None:
+    epoch = config_cache.begin_load()
+    with db_session(readonly=True) as db:
+        rows = db.execute("SELECT * FROM api_configs;").fetchall()
+    config_cache.fill(epoch, [api_config_row(r) for r in rows])
+
 def get_api_config(api_config_id: int) -> Dict[str, Any]:
-    with db_session() as db:
-        row = db.execute("SELECT * FROM api_configs WHERE id = ?;", (api_config_id,)).fetchone()
-        if row is None:
-            raise HTTPException(status_code=404, detail="API config not found")
-        return api_config_row(row)
+    # Served from config_cache; the returned dict is shared and must not be mutated.
+    with span("api_config"):
+        if not config_cache.loaded():
+            _load_api_configs()
+        cfg = config_cache.get(api_config_id)
+        if cfg is None and not config_cache.loaded():
+            # A concurrent write discarded the load; read this one row directly.
+            with db_session(readonly=True) as db:
+                row = db.execute("SELECT * FROM api_configs WHERE id = ?;", (api_config_id,)).fetchone()
+            cfg = api_config_row(row) if row is not None else None
+    if cfg is None:
+        raise HTTPException(status_code=404, detail="API config not found")
+    return cfg
+
+def list_pool_members(pool: str, kind: str) -> List[Dict[str, Any]]:
+    members = config_cache.pool_members(pool, kind)
+    if members is not None:
+        return members
+    with db_session(readonly=True) as db:
+        rows = db.execute("SELECT * FROM api_configs WHERE pool = ? AND kind = ? ORDER BY id;", (pool, kind)).fetchall()
+        return [api_config_row(r) for r in rows]
 
 @router.post("", response_model=ApiConfigOut)
 def create_api_config(payload: ApiConfigCreate) -> Dict[str, Any]:
     now = utc_now_iso()
     base_url = payload.base_url.rstrip("/")
     chat_path = payload.chat_completions_path if payload.chat_completions_path.startswith("/") else f"/{payload.chat_completions_path}"
+    _check_context_strategy(payload.context_strategy)
     with db_session() as db:
         cur = db.execute(
             """
-            INSERT INTO api_configs(name, kind, provider, base_url, api_key, model, chat_completions_path, extra_headers_json, temperature, created_at, updated_at)
-            VALUES(?,?,?,?,?,?,?,?,?,?,?);
+            INSERT INTO api_configs(name, kind, provider, base_url, api_key, model, chat_completions_path, extra_headers_json, temperature, context_tokens, context_strategy, max_concurrency, tokens_per_minute, pool, created_at, updated_at)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);
             """,
             (
                 payload.name,
@@ -33,17 +63,24 @@ def create_api_config(payload: ApiConfigCreate) -> Dict[str, Any]:
                 chat_path,
                 dumps_json_obj(payload.extra_headers),
                 payload.temperature,
+                payload.context_tokens,
+                payload.context_strategy,
+                payload.max_concurrency,
+                payload.tokens_per_minute,
+                payload.pool.strip(),
                 now,
                 now,
             ),
         )
         new_id = cur.lastrowid
         row = db.execute("SELECT * FROM api_configs WHERE id = ?;", (new_id,)).fetchone()
-        return api_config_row(row) 
+        cfg = api_config_row(row)
+        config_cache.put(cfg)
+        return cfg
 
 @router.get("", response_model=List[ApiConfigOut])
 def list_api_configs() -> List[Dict[str, Any]]:
-    with db_session() as db:
+    with db_session(readonly=True) as db:
         rows = db.execute("SELECT * FROM api_configs ORDER BY id DESC;").fetchall()
         return [api_config_row(r) for r in rows]
 
@@ -67,13 +104,19 @@ def update_api_config(api_config_id: int, payload: ApiConfigUpdate) -> Dict[str,
         "chat_completions_path": next_chat_path if next_chat_path is not None else existing["chat_completions_path"],
         "extra_headers": payload.extra_headers if payload.extra_headers is not None else existing["extra_headers"],
         "temperature": payload.temperature if payload.temperature is not None else existing["temperature"],
+        "context_tokens": payload.context_tokens if payload.context_tokens is not None else existing["context_tokens"],
+        "context_strategy": payload.context_strategy if payload.context_strategy is not None else existing["context_strategy"],
+        "max_concurrency": payload.max_concurrency if payload.max_concurrency is not None else existing["max_concurrency"],
+        "tokens_per_minute": payload.tokens_per_minute if payload.tokens_per_minute is not None else existing["tokens_per_minute"],
+        "pool": payload.pool.strip() if payload.pool is not None else existing["pool"],
     }
+    _check_context_strategy(merged["context_strategy"])
     now = utc_now_iso()
     with db_session() as db:
         db.execute(
             """
             UPDATE api_configs
-            SET name=?, kind=?, provider=?, base_url=?, api_key=?, model=?, chat_completions_path=?, extra_headers_json=?, temperature=?, updated_at=?
+            SET name=?, kind=?, provider=?, base_url=?, api_key=?, model=?, chat_completions_path=?, extra_headers_json=?, temperature=?, context_tokens=?, context_strategy=?, max_concurrency=?, tokens_per_minute=?, pool=?, updated_at=?
             WHERE id=?;
             """,
             (
@@ -86,16 +129,24 @@ def update_api_config(api_config_id: int, payload: ApiConfigUpdate) -> Dict[str,
                 merged["chat_completions_path"],
                 dumps_json_obj(merged["extra_headers"]),
                 merged["temperature"],
+                merged["context_tokens"],
+                merged["context_strategy"],
+                merged["max_concurrency"],
+                merged["tokens_per_minute"],
+                merged["pool"],
                 now,
                 api_config_id,
             ),
         )
         row = db.execute("SELECT * FROM api_configs WHERE id = ?;", (api_config_id,)).fetchone()
-        return api_config_row(row)
+        cfg = api_config_row(row)
+        config_cache.put(cfg)
+        return cfg
 
 @router.delete("/{api_config_id}")
 def delete_api_config(api_config_id: int) -> Dict[str, Any]:
     get_api_config(api_config_id)
     with db_session() as db:
         db.execute("DELETE FROM api_configs WHERE id = ?;", (api_config_id,))
+        config_cache.remove(api_config_id)
     return {"deleted": api_config_id}
@@ -0,0 +1,103 @@
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+BALANCER_EWMA_ALPHA = 0.3
+# Latency assumed for a member with no samples yet, so a cold-start burst is spread by
+# outstanding requests instead of piling onto whichever member sorts first.
+BALANCER_PRIOR_LATENCY = 0.5
+FAILURE_PENALTY = 5.0
+CIRCUIT_FAILURES = int(os.environ.get("VIPER_CIRCUIT_FAILURES") or 3)
+CIRCUIT_COOLDOWN = float(os.environ.get("VIPER_CIRCUIT_COOLDOWN") or 30)
+
+class MemberHealth:
+    def __init__(self) -> None:
+        self.ewma_latency = 0.0
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.successes = 0
+        self.failures = 0
+
+    def available(self, now: float) -> bool:
+        if not self.open_until:
+            return True
+        # After the cooldown the circuit is half-open: one probe request at a time.
+        return now >= self.open_until and not self.probing
+
+    def score(self) -> Tuple[float, int]:
+        # Least-outstanding-requests weighted by latency; ties go to fewer outstanding.
+        return (self.ewma_latency or BALANCER_PRIOR_LATENCY) * (self.outstanding + 1), self.outstanding
+
+    def state(self, now: float) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if now < self.open_until else "half_open"
+
+_health: Dict[int, MemberHealth] = {}
+
+def _member(api_config_id: int) -> MemberHealth:
+    health = _health.get(api_config_id)
+    if health is None:
+        health = _health[api_config_id] = MemberHealth()
+    return health
+
+def rank(members: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    if len(members) <= 1:
+        return members
+    now = time.monotonic()
+    healthy = [m for m in members if _member(m["id"]).available(now)]
+    if healthy:
+        return sorted(healthy, key=lambda m: _member(m["id"]).score())
+    # Every circuit is open: fail open towards the member that recovers first.
+    return sorted(members, key=lambda m: _member(m["id"]).open_until)
+
+def begin(api_config_id: int) -> None:
+    health = _member(api_config_id)
+    health.outstanding += 1
+    if health.open_until and time.monotonic() >= health.open_until:
+        health.probing = True
+
+def end(api_config_id: int) -> None:
+    health = _member(api_config_id)
+    health.outstanding -= 1
+    health.probing = False
+
+def _observe(health: MemberHealth, latency: float) -> None:
+    if health.ewma_latency:
+        health.ewma_latency += BALANCER_EWMA_ALPHA * (latency - health.ewma_latency)
+    else:
+        health.ewma_latency = latency
+
+def succeeded(api_config_id: int, latency: float) -> None:
+    health = _member(api_config_id)
+    health.successes += 1
+    health.consecutive_failures = 0
+    health.open_until = 0.0
+    health.probing = False
+    _observe(health, latency)
+
+def failed(api_config_id: int) -> None:
+    # Errors count as slow samples so a flaky member drops down the ranking
+    # before its circuit opens.
+    health = _member(api_config_id)
+    _observe(health, FAILURE_PENALTY)
+    health.failures += 1
+    health.consecutive_failures += 1
+    health.probing = False
+    if health.consecutive_failures >= CIRCUIT_FAILURES:
+        health.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+
+def balancer_stats() -> Dict[str, Any]:
+    now = time.monotonic()
+    return {
+        str(k): {
+            "ewma_latency_ms": round(h.ewma_latency * 1000, 3),
+            "outstanding": h.outstanding,
+            "successes": h.successes,
+            "failures": h.failures,
+            "circuit": h.state(now),
+        }
+        for k, h in _health.items()
+    }
@@ -0,0 +1,303 @@
+import asyncio
+import json
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from .api_configs import get_api_config
+from .chat import openai_compatible_chat
+from .db import batch_job_row, db_session, utc_now_iso
+from .schemas import BatchOut
+
+router = APIRouter(prefix="/batches", tags=["batches"])
+
+BATCH_WORKERS = int(os.environ.get("VIPER_BATCH_WORKERS") or 4)
+BATCH_MAX_WORKERS = 64
+BATCH_MAX_ITEMS = int(os.environ.get("VIPER_BATCH_MAX_ITEMS") or 100000)
+BATCH_MAX_ATTEMPTS = int(os.environ.get("VIPER_BATCH_MAX_ATTEMPTS") or 3)
+BATCH_RETRY_BACKOFF = 1.0
+BATCH_RESULT_PAGE = 500
+RETRYABLE_STATUS = (429, 502)
+
+_runners: Dict[int, "asyncio.Task[None]"] = {}
+
+def _parse_line(number: int, line: bytes) -> Tuple[Optional[str], str]:
+    # {"custom_id": ..., "messages": [...]} or {"custom_id": ..., "prompt": "...", "system_prompt": "..."}
+    try:
+        item = json.loads(line)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"line {number}: invalid JSON")
+    if not isinstance(item, dict):
+        raise HTTPException(status_code=400, detail=f"line {number}: expected an object")
+    messages = item.get("messages")
+    if messages is None and isinstance(item.get("prompt"), str):
+        messages = [{"role": "user", "content": item["prompt"]}]
+        if isinstance(item.get("system_prompt"), str) and item["system_prompt"].strip():
+            messages.insert(0, {"role": "system", "content": item["system_prompt"]})
+    if (
+        not isinstance(messages, list)
+        or not messages
+        or not all(isinstance(m, dict) and isinstance(m.get("role"), str) and isinstance(m.get("content"), str) for m in messages)
+    ):
+        raise HTTPException(status_code=400, detail=f"line {number}: expected prompt or messages")
+    custom_id = item.get("custom_id")
+    messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+    return (None if custom_id is None else str(custom_id)), json.dumps(messages, ensure_ascii=False)
+
+async def _read_items(request: Request) -> List[Tuple[Optional[str], str]]:
+    items: List[Tuple[Optional[str], str]] = []
+    tail = b""
+    number = 0
+    async for chunk in request.stream():
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            number += 1
+            if line.strip():
+                items.append(_parse_line(number, line))
+        if len(items) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"batches are limited to {BATCH_MAX_ITEMS} items")
+    if tail.strip():
+        items.append(_parse_line(number + 1, tail))
+    return items
+
+def _counts(db, job_id: int) -> Dict[str, int]:
+    rows = db.execute("SELECT status, COUNT(*) AS n FROM batch_items WHERE job_id = ? GROUP BY status;", (job_id,)).fetchall()
+    return {r["status"]: r["n"] for r in rows}
+
+def get_batch(job_id: int) -> Dict[str, Any]:
+    with db_session(readonly=True) as db:
+        row = db.execute("SELECT * FROM batch_jobs WHERE id = ?;", (job_id,)).fetchone()
+        if row is None:
+            raise HTTPException(status_code=404, detail="batch not found")
+        return batch_job_row(row, _counts(db, job_id))
+
+def _insert_batch(api_config_id: int, workers: int, temperature: float, items: List[Tuple[Optional[str], str]]) -> int:
+    now = utc_now_iso()
+    with db_session() as db:
+        job_id = db.execute(
+            """
+            INSERT INTO batch_jobs(api_config_id, status, workers, temperature, total, created_at, updated_at)
+            VALUES(?, 'pending', ?, ?, ?, ?, ?) RETURNING id;
+            """,
+            (api_config_id, workers, temperature, len(items), now, now),
+        ).fetchone()["id"]
+        db.executemany(
+            "INSERT INTO batch_items(job_id, custom_id, messages_json) VALUES(?,?,?);",
+            ((job_id, custom_id, messages_json) for custom_id, messages_json in items),
+        )
+        return job_id
+
+def _set_job_status(job_id: int, status: str, error: Optional[str] = None, only_if: Tuple[str, ...] = ()) -> None:
+    guard = f" AND status IN ({','.join('?' * len(only_if))})" if only_if else ""
+    with db_session() as db:
+        db.execute(
+            f"UPDATE batch_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?{guard};",
+            (status, error, utc_now_iso(), job_id, *only_if),
+        )
+
+def _claim(job_id: int) -> Optional[Dict[str, Any]]:
+    with db_session() as db:
+        row = db.execute(
+            """
+            UPDATE batch_items SET status = 'running', attempts = attempts + 1
+            WHERE id = (SELECT id FROM batch_items WHERE job_id = ? AND status = 'pending' ORDER BY id LIMIT 1)
+            RETURNING id, messages_json, attempts;
+            """,
+            (job_id,),
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+def _retry(item_id: int) -> int:
+    with db_session() as db:
+        return db.execute(
+            "UPDATE batch_items SET attempts = attempts + 1 WHERE id = ? RETURNING attempts;", (item_id,)
+        ).fetchone()["attempts"]
+
+def _record(item_id: int, status: str, content: Optional[str], response_json: Optional[str], error: Optional[str]) -> None:
+    with db_session() as db:
+        db.execute(
+            "UPDATE batch_items SET status = ?, content = ?, response_json = ?, error = ? WHERE id = ? AND status = 'running';",
+            (status, content, response_json, error, item_id),
+        )
+
+async def _process(cfg: Dict[str, Any], temperature: float, item: Dict[str, Any]) -> None:
+    messages = json.loads(item["messages_json"])
+    attempts = item["attempts"]
+    while True:
+        try:
+            raw, _ = await openai_compatible_chat(cfg, messages, temperature, priority="batch")
+        except HTTPException as e:
+            if e.status_code not in RETRYABLE_STATUS or attempts >= BATCH_MAX_ATTEMPTS:
+                await run_in_threadpool(_record, item["id"], "failed", None, None, str(e.detail))
+                return
+            await asyncio.sleep(BATCH_RETRY_BACKOFF * 2 ** (attempts - 1))
+            attempts = await run_in_threadpool(_retry, item["id"])
+            continue
+        try:
+            content = raw["choices"][0]["message"]["content"] or ""
+        except Exception:
+            content = None
+        await run_in_threadpool(_record, item["id"], "complete", content, json.dumps(raw, ensure_ascii=False), None)
+        return
+
+def _fail_job(job_id: int, error: str) -> None:
+    # Marked failed rather than left running, so a restart does not resume into the same error.
+    with db_session() as db:
+        db.execute(
+            "UPDATE batch_items SET status = 'failed', error = ? WHERE job_id = ? AND status IN ('pending', 'running');",
+            (f"job failed: {error}", job_id),
+        )
+    _set_job_status(job_id, "failed", error, ("pending", "running"))
+
+async def _run_job(job_id: int) -> None:
+    # Every item transition is committed as it happens, so a restarted backend
+    # resumes from the first pending item instead of the beginning.
+    try:
+        job = await run_in_threadpool(get_batch, job_id)
+        try:
+            cfg = await run_in_threadpool(get_api_config, job["api_config_id"])
+        except HTTPException as e:
+            await run_in_threadpool(_set_job_status, job_id, "failed", str(e.detail))
+            return
+        await run_in_threadpool(_set_job_status, job_id, "running")
+
+        async def worker() -> None:
+            while True:
+                item = await run_in_threadpool(_claim, job_id)
+                if item is None:
+                    return
+                try:
+                    await _process(cfg, job["temperature"], item)
+                except Exception as e:
+                    # One bad item fails alone; only an error recording it stops the job.
+                    await run_in_threadpool(_record, item["id"], "failed", None, None, f"{type(e).__name__}: {e}")
+
+        tasks = [asyncio.create_task(worker()) for _ in range(job["workers"])]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        await run_in_threadpool(_set_job_status, job_id, "complete", None, ("running",))
+    except Exception as e:
+        await run_in_threadpool(_fail_job, job_id, f"{type(e).__name__}: {e}")
+
+def _start(job_id: int) -> None:
+    task = asyncio.create_task(_run_job(job_id))
+    _runners[job_id] = task
+    task.add_done_callback(lambda _: _runners.pop(job_id, None))
+
+def _resumable_jobs() -> List[int]:
+    with db_session() as db:
+        db.execute(
+            """
+            UPDATE batch_items SET status = 'pending'
+            WHERE status = 'running' AND job_id IN (SELECT id FROM batch_jobs WHERE status IN ('pending', 'running'));
+            """
+        )
+        rows = db.execute("SELECT id FROM batch_jobs WHERE status IN ('pending', 'running') ORDER BY id;").fetchall()
+        return [r["id"] for r in rows]
+
+async def resume_batches() -> None:
+    # Items a previous process left running never got their result recorded; run them again.
+    for job_id in await run_in_threadpool(_resumable_jobs):
+        _start(job_id)
+
+async def stop_batches() -> None:
+    tasks = list(_runners.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def active_batch_count() -> int:
+    return len(_runners)
+
+@router.post("", response_model=BatchOut)
+async def create_batch(
+    request: Request,
+    api_config_id: int,
+    workers: int = Query(default=BATCH_WORKERS, ge=1, le=BATCH_MAX_WORKERS),
+    temperature: Optional[float] = None,
+) -> Dict[str, Any]:
+    cfg = await run_in_threadpool(get_api_config, api_config_id)
+    if cfg["kind"] != "openai_compatible":
+        raise HTTPException(status_code=400, detail="unsupported api_config.kind")
+    items = await _read_items(request)
+    if not items:
+        raise HTTPException(status_code=400, detail="batch has no items")
+    job_id = await run_in_threadpool(
+        _insert_batch, api_config_id, workers, cfg["temperature"] if temperature is None else temperature, items
+    )
+    _start(job_id)
+    return await run_in_threadpool(get_batch, job_id)
+
+@router.get("", response_model=List[BatchOut])
+def list_batches(limit: int = Query(default=50, ge=1, le=200)) -> List[Dict[str, Any]]:
+    with db_session(readonly=True) as db:
+        rows = db.execute("SELECT * FROM batch_jobs ORDER BY id DESC LIMIT ?;", (limit,)).fetchall()
+        return [batch_job_row(r, _counts(db, r["id"])) for r in rows]
+
+@router.get("/{job_id}", response_model=BatchOut)
+def read_batch(job_id: int) -> Dict[str, Any]:
+    return get_batch(job_id)
+
+def _cancel_items(job_id: int) -> None:
+    with db_session() as db:
+        db.execute("UPDATE batch_items SET status = 'cancelled' WHERE job_id = ? AND status IN ('pending', 'running');", (job_id,))
+
+@router.post("/{job_id}/cancel", response_model=BatchOut)
+async def cancel_batch(job_id: int) -> Dict[str, Any]:
+    await run_in_threadpool(get_batch, job_id)
+    task = _runners.get(job_id)
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await run_in_threadpool(_set_job_status, job_id, "cancelled", None, ("pending", "running"))
+    await run_in_threadpool(_cancel_items, job_id)
+    return await run_in_threadpool(get_batch, job_id)
+
+def _result_page(job_id: int, after_id: int) -> List[Any]:
+    with db_session(readonly=True) as db:
+        cur = db.execute(
+            """
+            SELECT id, custom_id, status, attempts, content, response_json, error FROM batch_items
+            WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?;
+            """,
+            (job_id, after_id, BATCH_RESULT_PAGE),
+        )
+        return cur.fetchmany(BATCH_RESULT_PAGE)
+
+def _result_line(row: Any) -> bytes:
+    head = json.dumps(
+        {
+            "id": row["id"],
+            "custom_id": row["custom_id"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "content": row["content"],
+            "error": row["error"],
+        },
+        ensure_ascii=False,
+    )
+    # The stored upstream body is already JSON; splice it in instead of re-encoding it.
+    return (head[:-1] + ', "response": ' + (row["response_json"] or "null") + "}\n").encode("utf-8")
+
+@router.get("/{job_id}/results")
+async def batch_results(job_id: int):
+    await run_in_threadpool(get_batch, job_id)
+
+    async def lines() -> AsyncIterator[bytes]:
+        after_id = 0
+        while True:
+            rows = await run_in_threadpool(_result_page, job_id, after_id)
+            if not rows:
+                return
+            after_id = rows[-1]["id"]
+            yield b"".join(_result_line(r) for r in rows)
+
+    headers = {"Content-Disposition": f'attachment; filename="batch-{job_id}.ndjson"'}
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers=headers)
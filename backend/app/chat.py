@@ -1,172 +1,379 @@
 import json
-from typing import Any, Dict, List, Optional
-from urllib.error import HTTPError, URLError
-from urllib.request import Request, urlopen
-from fastapi import APIRouter, HTTPException
+import math
+import time
+from contextlib import suppress
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+import anyio
+from fastapi import APIRouter, Header, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse
-from .api_configs import get_api_config
-from .schemas import ChatRequest, ChatResponse
-from .sessions import get_session, insert_message, list_messages
+from . import balancer
+from .metrics import UpstreamTimer, upstream_error
+from .coalesce import chat_flights, stream_flights
+from .api_configs import get_api_config, list_pool_members
+from .completion_cache import cache_key, completion_cache
+from .context import BLOCKING_STRATEGIES, build_context, estimate_tokens
+from .scheduler import SCHEDULER_MAX_RETRIES, SCHEDULER_MAX_RETRY_WAIT, Slot, get_limiter, parse_retry_after
+from .schemas import ChatRequest, ChatResponse, FanoutRequest
+from .sessions import get_session_config_id, insert_message, persist_turn
+from .sse import SSEDeltaParser, relay, sse_content
+from .streams import Generation, cancel_generations, get_generation, start_generation
+from .tracing import span
+from .upstream import acquire_client, build_chat_request, release_client
+
+if TYPE_CHECKING:
+    import httpx
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
-def openai_compatible_chat(base_url: str, chat_completions_path: str, api_key: Optional[str], model: str, extra_headers: Dict[str, Any], messages: List[Dict[str, str]], temperature: float) -> Dict[str, Any]:
-    chat_path = chat_completions_path if chat_completions_path.startswith("/") else f"/{chat_completions_path}"
-    url = base_url.rstrip("/") + chat_path
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "stream": False,
-    }
-    headers: Dict[str, str] = {"Content-Type": "application/json"}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-    for k, v in (extra_headers or {}).items():
-        if isinstance(v, str) and v is not None:
-            headers[k] = str(v)
-    req = Request(url, data=json.dumps(payload, ensure_ascii=False).encode("utf-8"), headers=headers, method="POST")
-    try:
-        with urlopen(req, timeout=120) as resp:
-            raw = resp.read().decode("utf-8")
-            return json.loads(raw)
-    except HTTPError as e:
-        detail = e.read().decode("utf-8", errors="ignore")
-        raise HTTPException(status_code=502, detail=f"upstream http error: {e.code}: {detail}")
-    except URLError as e:
-        raise HTTPException(status_code=502, detail=f"upstream url error: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"upstream error: {str(e)}")
+CACHE_HEADER = "X-Viper-Cache"
+GENERATION_HEADER = "X-Generation-Id"
 
-def _openai_compatible_request(base_url: str, chat_completions_path: str, api_key: Optional[str], model: str, extra_headers: Dict[str, Any], messages: List[Dict[str, str]], temperature: float) -> Request:
-    chat_path = chat_completions_path if chat_completions_path.startswith("/") else f"/{chat_completions_path}"
-    url = base_url.rstrip("/") + chat_path
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature,
-        "stream": True,
-    }
-    headers: Dict[str, str] = {"Content-Type": "application/json"}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-    for k, v in (extra_headers or {}).items():
-        if isinstance(v, str) and v is not None:
-            headers[k] = str(v)
-    return Request(url, data=json.dumps(payload, ensure_ascii=False).encode("utf-8"), headers=headers, method="POST")
-
-def _openai_compatible_stream(req: Request):
+async def _send_to(cfg: Dict[str, Any], messages: List[Dict[str, str]], temperature: float, stream: bool, priority: str, retries: int) -> Tuple["httpx.Response", Slot]:
+    # The returned slot holds one of the config's concurrency permits until released.
+    limiter = get_limiter(cfg)
+    cost = sum(estimate_tokens(m["content"]) for m in messages)
+    import httpx
+
+    for attempt in range(retries + 1):
+        slot = await limiter.acquire(cost, priority)
+        balancer.begin(cfg["id"])
+        slot.on_release.append(lambda: balancer.end(cfg["id"]))
+        client = acquire_client(cfg)
+        slot.on_release.append(lambda client=client: release_client(client))
+        req = build_chat_request(cfg, messages, temperature, stream=stream, client=client)
+        started = time.monotonic()
+        try:
+            resp = await client.send(req, stream=stream)
+        except httpx.RequestError as e:
+            upstream_error(cfg, "connect")
+            balancer.failed(cfg["id"])
+            slot.release()
+            raise HTTPException(status_code=502, detail=f"upstream url error: {str(e)}")
+        except Exception as e:
+            upstream_error(cfg, "error")
+            balancer.failed(cfg["id"])
+            slot.release()
+            raise HTTPException(status_code=502, detail=f"upstream error: {str(e)}")
+        except BaseException:
+            slot.release()
+            raise
+        if resp.status_code < 400:
+            balancer.succeeded(cfg["id"], time.monotonic() - started)
+            return resp, slot
+        detail = (await resp.aread()).decode("utf-8", errors="ignore")
+        await resp.aclose()
+        slot.release()
+        upstream_error(cfg, "rate_limited" if resp.status_code == 429 else f"http_{resp.status_code // 100}xx")
+        if resp.status_code != 429:
+            if resp.status_code < 500:
+                # The request itself was rejected (bad model, bad parameters, auth): another
+                # member or a retry would not do better, and the member is not unhealthy.
+                raise HTTPException(status_code=resp.status_code, detail=f"upstream http error: {resp.status_code}: {detail}")
+            balancer.failed(cfg["id"])
+            raise HTTPException(status_code=502, detail=f"upstream http error: {resp.status_code}: {detail}")
+        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+        limiter.rate_limit(retry_after)
+        if attempt == retries or retry_after > SCHEDULER_MAX_RETRY_WAIT:
+            raise HTTPException(
+                status_code=429,
+                detail=f"upstream rate limited: {detail}",
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+    raise AssertionError("unreachable")
+
+async def _send_upstream(cfg: Dict[str, Any], messages: List[Dict[str, str]], temperature: float, stream: bool, priority: str) -> Tuple["httpx.Response", Slot]:
+    # Pooled configs route to the best-scoring healthy member and fail over to the
+    # next one on connection errors, 5xx or 429 before any byte reaches the client.
+    members = [cfg]
+    if cfg.get("pool"):
+        members = await run_in_threadpool(list_pool_members, cfg["pool"], cfg["kind"])
+    candidates = balancer.rank(members or [cfg])
+    for i, member in enumerate(candidates):
+        last = i == len(candidates) - 1
+        try:
+            return await _send_to(member, messages, temperature, stream, priority, SCHEDULER_MAX_RETRIES if last else 0)
+        except HTTPException as e:
+            if last or e.status_code not in (429, 502):
+                raise
+    raise AssertionError("unreachable")
+
+async def openai_compatible_chat(cfg: Dict[str, Any], messages: List[Dict[str, str]], temperature: float, priority: str = "interactive") -> Tuple[Dict[str, Any], int]:
+    # Returns the response body and the id of the api_config (pool member) that produced it.
+    # Identical concurrent requests share one upstream call; callers must not mutate the result.
+    key = cache_key(cfg, messages, temperature, stream=False)
+    return await chat_flights.do(key, lambda: _complete(cfg, messages, temperature, priority))
+
+async def _complete(cfg: Dict[str, Any], messages: List[Dict[str, str]], temperature: float, priority: str) -> Tuple[Dict[str, Any], int]:
+    timer = UpstreamTimer(cfg)
+    with span("upstream"):
+        resp, slot = await _send_upstream(cfg, messages, temperature, stream=False, priority=priority)
     try:
-        return urlopen(req, timeout=120)
-    except HTTPError as e:
-        detail = e.read().decode("utf-8", errors="ignore")
-        raise HTTPException(status_code=502, detail=f"upstream http error: {e.code}: {detail}")
-    except URLError as e:
-        raise HTTPException(status_code=502, detail=f"upstream url error: {str(e)}")
+        with span("json_decode"):
+            raw = json.loads(resp.content.decode("utf-8"))
     except Exception as e:
+        slot.release()
+        upstream_error(cfg, "invalid_body")
+        timer.finish(0, "error")
         raise HTTPException(status_code=502, detail=f"upstream error: {str(e)}")
+    tokens = estimate_tokens(resp.text)
+    slot.release(tokens)
+    timer.finish(tokens, "complete")
+    return raw, slot.api_config_id
 
-@router.post("/chat", response_model=ChatResponse)
-def chat(payload: ChatRequest) -> Dict[str, Any]:
-    session = get_session(payload.session_id)
+async def _openai_compatible_stream(cfg: Dict[str, Any], messages: List[Dict[str, str]], temperature: float, priority: str = "interactive") -> Tuple["httpx.Response", Slot]:
+    return await _send_upstream(cfg, messages, temperature, stream=True, priority=priority)
+
+async def _prepare_turn(payload: ChatRequest) -> Tuple[Dict[str, Any], List[Dict[str, str]], int]:
+    # Returns the config, the upstream messages and the id of the user message being answered.
     api_config_id = payload.api_config_id
     if api_config_id is None:
-        api_config_id = session.get("api_config_id")
+        api_config_id = await run_in_threadpool(get_session_config_id, payload.session_id)
     if api_config_id is None:
         raise HTTPException(status_code=400, detail="api_config_id is required (payload or session)")
-    cfg = get_api_config(int(api_config_id))
+    cfg = await run_in_threadpool(get_api_config, int(api_config_id))
     if cfg["kind"] != "openai_compatible":
         raise HTTPException(status_code=400, detail="unsupported api_config.kind")
-    if payload.system_prompt:
-        insert_message(payload.session_id, "system", payload.system_prompt)
-    insert_message(payload.session_id, "user", payload.user_content)
-    history = list_messages(payload.session_id)
-    upstream_messages = [{"role": m["role"], "content": m["content"]} for m in history]
-    raw = openai_compatible_chat(
-        base_url=cfg["base_url"],
-        chat_completions_path=cfg.get("chat_completions_path") or "/v1/chat/completions",
-        api_key=cfg["api_key"],
-        model=cfg["model"],
-        extra_headers=cfg["extra_headers"],
-        messages=upstream_messages,
-        temperature=payload.temperature,
+    history = await run_in_threadpool(
+        persist_turn, payload.session_id, payload.user_content, payload.system_prompt, payload.parent_message_id
     )
+    upstream_messages = await _build_context(history, cfg)
+    return cfg, upstream_messages, history[-1]["id"]
+
+async def _build_context(history: List[Dict[str, Any]], cfg: Dict[str, Any]) -> List[Dict[str, str]]:
+    with span("build_context"):
+        if cfg["context_tokens"] > 0 and cfg["context_strategy"] in BLOCKING_STRATEGIES:
+            return await run_in_threadpool(build_context, history, cfg["context_tokens"], cfg["context_strategy"])
+        return build_context(history, cfg["context_tokens"], cfg["context_strategy"])
+
+async def _cached_completion(key: str) -> Optional[bytes]:
+    body = completion_cache.get(key)
+    if body is None:
+        body = await run_in_threadpool(completion_cache.load, key)
+    return body
+
+@router.post("/chat", response_model=ChatResponse)
+async def chat(payload: ChatRequest, response: Response) -> Dict[str, Any]:
+    cfg, upstream_messages, parent_id = await _prepare_turn(payload)
+    key = cache_key(cfg, upstream_messages, payload.temperature, stream=False) if payload.cache else None
+    body = await _cached_completion(key) if key else None
+    answered_by = cfg["id"]
+    if body is not None:
+        raw = json.loads(body)
+        response.headers[CACHE_HEADER] = "hit"
+    else:
+        raw, answered_by = await openai_compatible_chat(cfg, upstream_messages, payload.temperature, payload.priority)
+        if key:
+            with span("json_encode"):
+                body = json.dumps(raw, ensure_ascii=False).encode("utf-8")
+            await run_in_threadpool(completion_cache.put, key, body)
+            response.headers[CACHE_HEADER] = "miss"
     assistant_content = ""
     try:
         assistant_content = raw["choices"][0]["message"]["content"] or ""
     except Exception:
         assistant_content = json.dumps(raw, ensure_ascii=False)
-    insert_message(payload.session_id, "assistant", assistant_content)
+    await run_in_threadpool(insert_message, payload.session_id, "assistant", assistant_content, "complete", answered_by, None, parent_id)
     return {"session_id": payload.session_id, "assistant_content": assistant_content, "raw": raw}
 
 @router.post("/stream")
-def chat_stream(payload: ChatRequest):
-    session = get_session(payload.session_id)
-    api_config_id = payload.api_config_id
-    if api_config_id is None:
-        api_config_id = session.get("api_config_id")
-    if api_config_id is None:
-        raise HTTPException(status_code=400, detail="api_config_id is required (payload or session)")
-    cfg = get_api_config(int(api_config_id))
-    if cfg["kind"] != "openai_compatible":
-        raise HTTPException(status_code=400, detail="unsupported api_config.kind")
-    if payload.system_prompt:
-        insert_message(payload.session_id, "system", payload.system_prompt)
-    insert_message(payload.session_id, "user", payload.user_content)
-    history = list_messages(payload.session_id)
-    upstream_messages = [{"role": m["role"], "content": m["content"]} for m in history]
-
-    req = _openai_compatible_request(
-        base_url=cfg["base_url"],
-        chat_completions_path=cfg.get("chat_completions_path") or "/v1/chat/completions",
-        api_key=cfg["api_key"],
-        model=cfg["model"],
-        extra_headers=cfg["extra_headers"],
-        messages=upstream_messages,
-        temperature=payload.temperature,
-    )
-    upstream = _openai_compatible_stream(req)
+async def chat_stream(payload: ChatRequest):
+    cfg, upstream_messages, parent_id = await _prepare_turn(payload)
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+    }
+    key = cache_key(cfg, upstream_messages, payload.temperature, stream=True) if payload.cache else None
+    cached = await _cached_completion(key) if key else None
+    if cached is not None:
+        await run_in_threadpool(insert_message, payload.session_id, "assistant", sse_content(cached), "complete", cfg["id"], None, parent_id)
+
+        async def replay():
+            yield cached
+
+        return StreamingResponse(replay(), media_type="text/event-stream", headers={**headers, CACHE_HEADER: "hit"})
+
+    flight_key = key or cache_key(cfg, upstream_messages, payload.temperature, stream=True)
+    leader = await stream_flights.join(flight_key, payload.session_id, parent_id)
+    if leader is not None:
+        if key:
+            headers[CACHE_HEADER] = "miss"
+        headers[GENERATION_HEADER] = leader.id
+        return StreamingResponse(leader.subscribe(session_id=payload.session_id), media_type="text/event-stream", headers=headers)
 
-    assistant_pieces: List[str] = []
+    flight = stream_flights.lead(flight_key)
+    timer = UpstreamTimer(cfg)
+    try:
+        with span("upstream"):
+            upstream, slot = await _openai_compatible_stream(cfg, upstream_messages, payload.temperature, payload.priority)
+    except BaseException:
+        stream_flights.end(flight_key, flight)
+        raise
+
+    parser = SSEDeltaParser()
+    recorded: List[bytes] = []
+    # Sessions that cancelled while coalesced sessions kept the stream going keep what they had.
+    detached: Dict[int, str] = {}
 
-    def iterator():
-        nonlocal assistant_pieces
+    async def produce(gen: Generation) -> None:
+        status = "truncated"
         try:
-            with upstream as resp:
-                while True:
-                    raw_line = resp.readline()
-                    if not raw_line:
-                        break
-                    yield raw_line
-
-                    try:
-                        line = raw_line.decode("utf-8", errors="ignore").strip()
-                    except Exception:
-                        continue
-                    if not line.startswith("data:"):
-                        continue
-                    data_str = line.replace("data:", "", 1).strip()
-                    if data_str == "[DONE]":
+            with span("relay"):
+                async for chunk in relay(upstream.aiter_bytes()):
+                    timer.first_byte()
+                    gen.publish(chunk)
+                    if key:
+                        recorded.append(chunk)
+                    parser.feed(chunk)
+                    if parser.done:
                         break
-                    try:
-                        event = json.loads(data_str)
-                    except Exception:
-                        continue
-                    choice0 = event.get("choices", [{}])[0] if isinstance(event, dict) else {}
-                    delta = choice0.get("delta") if isinstance(choice0, dict) else None
-                    piece = delta.get("content") if isinstance(delta, dict) else None
-                    if isinstance(piece, str) and piece:
-                        assistant_pieces.append(piece)
+            status = "complete"
+        except Exception:
+            status = "error"
+            raise
         finally:
-            assistant_content = "".join(assistant_pieces)
-            insert_message(payload.session_id, "assistant", assistant_content)
-
-    return StreamingResponse(
-        iterator(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
+            # Runs on completion, upstream failure, client disconnect and /chat/cancel alike.
+            # The slot is released before the first await and the rest is shielded, so a
+            # repeated cancel or the resume grace timer cannot cut the cleanup short.
+            followers = stream_flights.end(flight_key, flight)
+            parser.close()
+            tokens = estimate_tokens(parser.content)
+            slot.release(tokens)
+            timer.finish(tokens, status)
+            with anyio.CancelScope(shield=True):
+                # The upstream connection is dropped first so generation stops.
+                await upstream.aclose()
+                for session_id, parent in [(payload.session_id, parent_id), *followers]:
+                    content, saved = (detached[session_id], "truncated") if session_id in detached else (parser.content, status)
+                    await run_in_threadpool(insert_message, session_id, "assistant", content, saved, slot.api_config_id, None, parent)
+                if key and status == "complete":
+                    await run_in_threadpool(completion_cache.put, key, b"".join(recorded))
+            if status != "error":
+                # Errors are finished by the generation runner, which adds the error event.
+                gen.finish(status)
+
+    gen = start_generation(payload.session_id, produce)
+    gen.on_detach.append(lambda session_id: detached.setdefault(session_id, parser.content))
+    stream_flights.start(flight, gen)
+    if key:
+        headers[CACHE_HEADER] = "miss"
+    headers[GENERATION_HEADER] = gen.id
+    return StreamingResponse(gen.subscribe(session_id=payload.session_id), media_type="text/event-stream", headers=headers)
+
+def _fanout_event(api_config_id: int, fields: bytes) -> bytes:
+    return b'data: {"api_config_id":%d,%s}\n\n' % (api_config_id, fields)
+
+@router.post("/fanout")
+async def chat_fanout(payload: FanoutRequest):
+    # One prompt, several api_configs: every upstream call runs concurrently and the
+    # events are multiplexed into a single SSE stream, each tagged with its config.
+    cfgs: List[Dict[str, Any]] = []
+    for api_config_id in dict.fromkeys(payload.api_config_ids):
+        cfg = await run_in_threadpool(get_api_config, api_config_id)
+        if cfg["kind"] != "openai_compatible":
+            raise HTTPException(status_code=400, detail="unsupported api_config.kind")
+        cfgs.append(cfg)
+    history = await run_in_threadpool(
+        persist_turn, payload.session_id, payload.user_content, payload.system_prompt, payload.parent_message_id
     )
+    user_message_id = history[-1]["id"]
+
+    async def answer(gen: Generation, cfg: Dict[str, Any]) -> None:
+        # Every failure stays inside its own config: the others keep streaming and
+        # this one still ends with a done event.
+        timer = UpstreamTimer(cfg)
+        try:
+            messages = await _build_context(history, cfg)
+            upstream, slot = await _openai_compatible_stream(cfg, messages, payload.temperature, payload.priority)
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else f"upstream error: {str(e)}"
+            gen.publish(_fanout_event(cfg["id"], b'"error":%s,"done":true,"status":"error"' % json.dumps(detail, ensure_ascii=False).encode("utf-8")))
+            return
+        parser = SSEDeltaParser(keep_events=True)
+        status = "truncated"
+        error: Optional[str] = None
+        try:
+            async for chunk in upstream.aiter_bytes():
+                timer.first_byte()
+                parser.feed(chunk)
+                for event in parser.events:
+                    gen.publish(_fanout_event(cfg["id"], b'"chunk":' + event))
+                parser.events.clear()
+                if parser.done:
+                    break
+            status = "complete"
+        except Exception as e:
+            upstream_error(cfg, "stream")
+            status = "error"
+            error = f"upstream error: {str(e)}"
+        finally:
+            parser.close()
+            tokens = estimate_tokens(parser.content)
+            slot.release(tokens)
+            timer.finish(tokens, status)
+            message_id = 0
+            with anyio.CancelScope(shield=True):
+                with suppress(Exception):
+                    # A broken upstream must not take the other configs down with it.
+                    await upstream.aclose()
+                try:
+                    message = await run_in_threadpool(
+                        insert_message, payload.session_id, "assistant", parser.content, status, slot.api_config_id, user_message_id, user_message_id
+                    )
+                    message_id = message["id"]
+                except Exception as e:
+                    status = "error"
+                    error = error or f"save failed: {str(e)}"
+            fields = b'"done":true,"status":"%s"' % status.encode()
+            if message_id:
+                fields += b',"message_id":%d' % message_id
+            if error is not None:
+                fields = b'"error":%s,' % json.dumps(error, ensure_ascii=False).encode("utf-8") + fields
+            gen.publish(_fanout_event(cfg["id"], fields))
+
+    async def produce(gen: Generation) -> None:
+        # A task group rather than gather(): cancelling the generation then reaches each
+        # answer through its anyio scope, which keeps their shielded cleanup intact.
+        async with anyio.create_task_group() as tg:
+            for cfg in cfgs:
+                tg.start_soon(answer, gen, cfg)
+        gen.publish(b"data: [DONE]\n\n")
+        gen.finish("complete")
+
+    gen = start_generation(payload.session_id, produce)
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        GENERATION_HEADER: gen.id,
+    }
+    return StreamingResponse(gen.subscribe(), media_type="text/event-stream", headers=headers)
+
+@router.get("/stream/{generation_id}")
+async def resume_stream(
+    generation_id: str,
+    last_event_id_header: Optional[str] = Header(default=None, alias="Last-Event-ID"),
+    last_event_id: Optional[int] = None,
+):
+    gen = get_generation(generation_id)
+    if gen is None:
+        raise HTTPException(status_code=404, detail="generation not found")
+    if last_event_id is None and last_event_id_header:
+        try:
+            last_event_id = int(last_event_id_header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid Last-Event-ID")
+    if not gen.replayable(last_event_id):
+        raise HTTPException(status_code=410, detail="events after Last-Event-ID are no longer buffered")
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        GENERATION_HEADER: gen.id,
+    }
+    return StreamingResponse(gen.subscribe(last_event_id), media_type="text/event-stream", headers=headers)
+
+@router.post("/cancel/{session_id}")
+async def cancel(session_id: int) -> Dict[str, Any]:
+    return {"session_id": session_id, "cancelled": cancel_generations(session_id)}
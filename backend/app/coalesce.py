@@ -0,0 +1,97 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from .streams import Generation, attach_generation
+
+COALESCE_ENABLED = (os.environ.get("VIPER_COALESCE") or "1") != "0"
+
+class SingleFlight:
+    # Identical concurrent calls share one in-flight task. The task is not owned by
+    # any caller, so the leader disconnecting does not fail its followers.
+    def __init__(self) -> None:
+        self._calls: Dict[str, "asyncio.Task[Any]"] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key) if COALESCE_ENABLED else None
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            if COALESCE_ENABLED:
+                self._calls[key] = task
+                task.add_done_callback(lambda t: self._forget(key, t))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: "asyncio.Task[Any]") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+class StreamFlight:
+    def __init__(self) -> None:
+        self.gen: Optional[Generation] = None
+        self.ready: "asyncio.Future[Optional[Generation]]" = asyncio.get_running_loop().create_future()
+        # (session_id, user message id) for each follower; the reply is saved under that message.
+        self.followers: List[Tuple[int, int]] = []
+
+class StreamFlights:
+    # Streams coalesce on the leader's Generation: a follower subscribes from the
+    # first event, so it replays what was already emitted and then follows the
+    # live tail. The leader saves an assistant message for every follower session.
+    # Flights are registered before the upstream is opened, so requests arriving
+    # while the leader waits for its slot or response headers still coalesce.
+    def __init__(self) -> None:
+        self._flights: Dict[str, StreamFlight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def join(self, key: str, session_id: int, parent_id: int) -> Optional[Generation]:
+        flight = self._flights.get(key) if COALESCE_ENABLED else None
+        if flight is None:
+            return None
+        gen = flight.gen or await asyncio.shield(flight.ready)
+        if gen is None or gen.status != "running" or not gen.replayable(None) or self._flights.get(key) is not flight:
+            return None
+        flight.followers.append((session_id, parent_id))
+        attach_generation(gen, session_id)
+        self.coalesced += 1
+        return gen
+
+    def lead(self, key: str) -> StreamFlight:
+        self.leaders += 1
+        flight = StreamFlight()
+        if COALESCE_ENABLED:
+            self._flights[key] = flight
+        return flight
+
+    def start(self, flight: StreamFlight, gen: Generation) -> None:
+        flight.gen = gen
+        flight.ready.set_result(gen)
+
+    def end(self, key: str, flight: StreamFlight) -> List[Tuple[int, int]]:
+        # Followers waiting on a leader that never started fall back to their own upstream call.
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.ready.done():
+            flight.ready.set_result(None)
+        return flight.followers
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+chat_flights = SingleFlight()
+stream_flights = StreamFlights()
+
+def coalesce_stats() -> Dict[str, Any]:
+    return {
+        "enabled": COALESCE_ENABLED,
+        "chat": {"leaders": chat_flights.leaders, "coalesced": chat_flights.coalesced, "in_flight": chat_flights.in_flight()},
+        "stream": {"leaders": stream_flights.leaders, "coalesced": stream_flights.coalesced, "in_flight": stream_flights.in_flight()},
+    }
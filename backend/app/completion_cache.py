@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from .db import db_session
+
+COMPLETION_CACHE_TTL = float(os.environ.get("VIPER_COMPLETION_CACHE_TTL") or 7 * 24 * 3600)
+COMPLETION_CACHE_MAX_ENTRIES = int(os.environ.get("VIPER_COMPLETION_CACHE_MAX_ENTRIES") or 5000)
+COMPLETION_CACHE_MEMORY_ENTRIES = int(os.environ.get("VIPER_COMPLETION_CACHE_MEMORY_ENTRIES") or 256)
+PRUNE_EVERY = 64
+
+def cache_key(cfg: Dict[str, Any], messages: List[Dict[str, str]], temperature: float, stream: bool) -> str:
+    material = [
+        cfg["base_url"],
+        cfg["model"],
+        cfg.get("chat_completions_path") or "/v1/chat/completions",
+        temperature,
+        stream,
+        messages,
+    ]
+    blob = json.dumps(material, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+class CompletionCache:
+    # In-memory LRU in front of the completion_cache table. Bodies are the raw
+    # upstream bytes: a JSON document for /chat/chat, the SSE stream for /chat/stream.
+    def __init__(self, memory_entries: int, max_entries: int, ttl: float) -> None:
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return entry[1]
+
+    def load(self, key: str) -> Optional[bytes]:
+        with db_session(readonly=True) as db:
+            row = db.execute(
+                "SELECT body, expires_at FROM completion_cache WHERE key = ? AND expires_at >= ?;",
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        body = bytes(row["body"])
+        with self._lock:
+            self.store_hits += 1
+            self._remember(key, row["expires_at"], body)
+        return body
+
+    def put(self, key: str, body: bytes) -> None:
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, body)
+            self._puts += 1
+            prune = self._puts % PRUNE_EVERY == 1
+        with db_session() as db:
+            db.execute(
+                """
+                INSERT INTO completion_cache(key, body, created_at, expires_at) VALUES(?,?,?,?)
+                ON CONFLICT(key) DO UPDATE SET body = excluded.body, created_at = excluded.created_at, expires_at = excluded.expires_at;
+                """,
+                (key, body, now, expires_at),
+            )
+            if prune:
+                db.execute("DELETE FROM completion_cache WHERE expires_at < ?;", (now,))
+                db.execute(
+                    "DELETE FROM completion_cache WHERE key IN (SELECT key FROM completion_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?);",
+                    (self.max_entries,),
+                )
+
+    def _remember(self, key: str, expires_at: float, body: bytes) -> None:
+        if self.memory_entries <= 0:
+            return
+        self._memory[key] = (expires_at, body)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+            }
+
+completion_cache = CompletionCache(COMPLETION_CACHE_MEMORY_ENTRIES, COMPLETION_CACHE_MAX_ENTRIES, COMPLETION_CACHE_TTL)
@@ -0,0 +1,58 @@
+import os
+import threading
+import zlib
+from typing import Any, Optional, Tuple, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# chat_messages.content holds TEXT for short messages and a compressed BLOB above
+# CONTENT_COMPRESS_MIN_BYTES; chat_messages.codec says which ('' means plain).
+CONTENT_COMPRESS_MIN_BYTES = int(os.environ.get("VIPER_CONTENT_COMPRESS_MIN_BYTES") or 2048)
+CONTENT_CODEC = os.environ.get("VIPER_CONTENT_CODEC") or ("zstd" if zstandard is not None else "zlib")
+CONTENT_MIN_SAVING = 0.9
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 6
+
+# zstandard contexts are not thread-safe; DB work runs on the threadpool.
+_zstd = threading.local()
+
+def _zstd_context(name: str) -> Any:
+    ctx = getattr(_zstd, name, None)
+    if ctx is None:
+        ctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if name == "compressor" else zstandard.ZstdDecompressor()
+        setattr(_zstd, name, ctx)
+    return ctx
+
+def _compress(data: bytes, codec: str) -> Optional[bytes]:
+    if codec == "zlib":
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == "zstd" and zstandard is not None:
+        return _zstd_context("compressor").compress(data)
+    return None
+
+def encode_content(text: str) -> Tuple[Union[str, bytes], str]:
+    # Returns the value to store and its codec; incompressible text stays plain.
+    # At most 4 UTF-8 bytes per char, so short strings skip the encode entirely.
+    if len(text) * 4 < CONTENT_COMPRESS_MIN_BYTES:
+        return text, ""
+    data = text.encode("utf-8")
+    if len(data) < CONTENT_COMPRESS_MIN_BYTES:
+        return text, ""
+    packed = _compress(data, CONTENT_CODEC)
+    if packed is None or len(packed) > len(data) * CONTENT_MIN_SAVING:
+        return text, ""
+    return packed, CONTENT_CODEC
+
+def decode_content(value: Union[str, bytes, None], codec: Optional[str]) -> str:
+    if not codec:
+        return value if isinstance(value, str) else (value or b"").decode("utf-8")
+    if codec == "zlib":
+        return zlib.decompress(value).decode("utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("message is zstd-compressed but the zstandard package is not installed")
+        return _zstd_context("decompressor").decompress(value).decode("utf-8")
+    raise RuntimeError(f"unknown content codec: {codec}")
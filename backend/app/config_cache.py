@@ -0,0 +1,123 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from .upstream import chat_headers, chat_url
+
+SESSION_CONFIG_CACHE_SESSIONS = int(os.environ.get("VIPER_SESSION_CONFIG_CACHE_SESSIONS") or 4096)
+
+def _prepare(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    # The upstream URL and headers are built once per config version, not per request.
+    return {
+        **cfg,
+        "url": chat_url(cfg["base_url"], cfg.get("chat_completions_path")),
+        "headers": chat_headers(cfg["api_key"], cfg["extra_headers"]),
+    }
+
+class ConfigCache:
+    # Every api_config, loaded on first use and kept current by write-through
+    # updates made under the writer lock, plus an LRU of session -> api_config_id.
+    # Once loaded the config table is authoritative, so unknown ids need no DB read.
+    # Loads publish only if no write happened meanwhile (same epoch scheme as HistoryCache).
+    def __init__(self, session_capacity: int) -> None:
+        self.session_capacity = session_capacity
+        self._configs: Optional[Dict[int, Dict[str, Any]]] = None
+        self._pools: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self._sessions: "OrderedDict[int, Optional[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.hits = 0
+        self.loads = 0
+
+    def begin_load(self) -> int:
+        with self._lock:
+            return self._epoch
+
+    def loaded(self) -> bool:
+        return self._configs is not None
+
+    def get(self, api_config_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._configs is None:
+                return None
+            self.hits += 1
+            return self._configs.get(api_config_id)
+
+    def fill(self, epoch: int, configs: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._configs = {cfg["id"]: _prepare(cfg) for cfg in configs}
+            self._pools.clear()
+            self.loads += 1
+
+    def pool_members(self, pool: str, kind: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            if self._configs is None:
+                return None
+            members = self._pools.get((pool, kind))
+            if members is None:
+                members = [c for _, c in sorted(self._configs.items()) if c["pool"] == pool and c["kind"] == kind]
+                self._pools[(pool, kind)] = members
+            return list(members)
+
+    def put(self, cfg: Dict[str, Any]) -> None:
+        with self._lock:
+            self._epoch += 1
+            if self._configs is not None:
+                self._configs[cfg["id"]] = _prepare(cfg)
+            self._pools.clear()
+
+    def remove(self, api_config_id: int) -> None:
+        with self._lock:
+            self._epoch += 1
+            if self._configs is not None:
+                self._configs.pop(api_config_id, None)
+            self._pools.clear()
+            # chat_sessions.api_config_id is ON DELETE SET NULL.
+            for session_id, bound in self._sessions.items():
+                if bound == api_config_id:
+                    self._sessions[session_id] = None
+
+    def session_config(self, session_id: int) -> Tuple[bool, Optional[int]]:
+        with self._lock:
+            if session_id not in self._sessions:
+                return False, None
+            self._sessions.move_to_end(session_id)
+            return True, self._sessions[session_id]
+
+    def set_session_config(self, session_id: int, api_config_id: Optional[int], epoch: Optional[int] = None) -> None:
+        if self.session_capacity <= 0:
+            return
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._epoch += 1
+            self._sessions[session_id] = api_config_id
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.session_capacity:
+                self._sessions.popitem(last=False)
+
+    def forget_session(self, session_id: int) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._sessions.pop(session_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._configs = None
+            self._pools.clear()
+            self._sessions.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "configs": len(self._configs) if self._configs is not None else None,
+                "sessions": len(self._sessions),
+                "session_capacity": self.session_capacity,
+                "hits": self.hits,
+                "loads": self.loads,
+            }
+
+config_cache = ConfigCache(SESSION_CONFIG_CACHE_SESSIONS)
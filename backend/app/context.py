@@ -0,0 +1,118 @@
+import os
+from typing import Any, Callable, Dict, List, Set, Tuple
+from .retrieval import vector_index
+
+ContextStrategy = Callable[[List[Dict[str, Any]], int], List[Dict[str, Any]]]
+
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_SHARE = 4
+SUMMARY_SNIPPET_CHARS = 240
+
+RETRIEVAL_SHARE = 3
+RETRIEVAL_TOP_K = int(os.environ.get("VIPER_RETRIEVAL_TOP_K") or 8)
+RETRIEVAL_HEADER = "Relevant earlier messages:"
+
+STRATEGIES: Dict[str, ContextStrategy] = {}
+# Strategies that touch the database or do heavy math; callers run them off the event loop.
+BLOCKING_STRATEGIES: Set[str] = set()
+
+def estimate_tokens(text: str) -> int:
+    # Cheap tokenizer-free estimate: ~4 ASCII chars per token, ~1 token per CJK/other
+    # multi-byte char (3 UTF-8 bytes each, so 2 extra bytes per char).
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    chars = len(text)
+    wide = (len(text.encode("utf-8", errors="ignore")) - chars) // 2
+    return MESSAGE_OVERHEAD_TOKENS + wide + (chars - wide + 3) // 4
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    count = message.get("token_count")
+    return count if count is not None else estimate_tokens(message["content"])
+
+def register_strategy(name: str, blocking: bool = False) -> Callable[[ContextStrategy], ContextStrategy]:
+    def decorator(fn: ContextStrategy) -> ContextStrategy:
+        STRATEGIES[name] = fn
+        if blocking:
+            BLOCKING_STRATEGIES.add(name)
+        return fn
+    return decorator
+
+def _split_window(history: List[Dict[str, Any]], budget: int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]:
+    systems = [m for m in history if m["role"] == "system"]
+    turns = [m for m in history if m["role"] != "system"]
+    remaining = budget - sum(message_tokens(m) for m in systems)
+    start = len(turns)
+    while start > 0:
+        cost = message_tokens(turns[start - 1])
+        # The newest message always goes upstream, even if it alone exceeds the budget.
+        if cost > remaining and start < len(turns):
+            break
+        remaining -= cost
+        start -= 1
+    return systems, turns[start:], turns[:start]
+
+@register_strategy("full")
+def full_history(history: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    return history
+
+@register_strategy("window")
+def sliding_window(history: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    systems, window, _ = _split_window(history, budget)
+    return systems + window
+
+@register_strategy("summary")
+def rolling_summary(history: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    summary_budget = budget // SUMMARY_SHARE
+    systems, window, dropped = _split_window(history, budget - summary_budget)
+    if not dropped:
+        return systems + window
+    lines: List[str] = []
+    used = estimate_tokens("Summary of earlier conversation:")
+    for m in reversed(dropped):
+        snippet = " ".join(m["content"][:SUMMARY_SNIPPET_CHARS].split())
+        line = f"- {m['role']}: {snippet}"
+        cost = estimate_tokens(line) - MESSAGE_OVERHEAD_TOKENS
+        if used + cost > summary_budget:
+            break
+        lines.append(line)
+        used += cost
+    if not lines:
+        return systems + window
+    summary = {"role": "system", "content": "Summary of earlier conversation:\n" + "\n".join(reversed(lines))}
+    return systems + [summary] + window
+
+@register_strategy("retrieval", blocking=True)
+def retrieval(history: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    # Recent turns as in "window", plus the older messages most similar to the
+    # latest user message, so the prompt stays within budget however long the
+    # session grows.
+    recall_budget = budget // RETRIEVAL_SHARE
+    systems, window, dropped = _split_window(history, budget - recall_budget)
+    query = next((m["content"] for m in reversed(window) if m["role"] == "user"), None)
+    if not dropped or query is None:
+        return systems + window
+    try:
+        ranked = vector_index.search(dropped[0]["session_id"], query, dropped, RETRIEVAL_TOP_K)
+    except ImportError:
+        # NumPy is optional; without it this degrades to the sliding window.
+        return systems + window
+    picked: List[Tuple[int, str]] = []
+    used = estimate_tokens(RETRIEVAL_HEADER)
+    for m in ranked:
+        line = f"- {m['role']}: {m['content']}"
+        cost = estimate_tokens(line) - MESSAGE_OVERHEAD_TOKENS
+        if used + cost > recall_budget or any(line == p for _, p in picked):
+            continue
+        picked.append((m["id"], line))
+        used += cost
+    if not picked:
+        return systems + window
+    recalled = {"role": "system", "content": RETRIEVAL_HEADER + "\n" + "\n".join(line for _, line in sorted(picked))}
+    return systems + [recalled] + window
+
+def build_context(history: List[Dict[str, Any]], budget: int, strategy: str) -> List[Dict[str, str]]:
+    # history is one branch of the message tree, so fan-out siblings are already excluded.
+    selected = history
+    if budget > 0:
+        selected = STRATEGIES.get(strategy, sliding_window)(selected, budget)
+    return [{"role": m["role"], "content": m["content"]} for m in selected]
@@ -1,10 +1,17 @@
 import json
 import os
+import queue
 import sqlite3
+import sys
+import threading
+import time
 from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Iterator, Optional
+from typing import Any, ContextManager, Dict, Iterator, Optional
+from .compression import decode_content
+from .metrics import db_latency
+from .tracing import span
 
 def _default_db_path() -> Path:
     if os.name == "nt":
@@ -22,84 +29,155 @@ DB_PATH = Path(os.environ.get("VIPER_DB_PATH") or _default_db_path())
 def utc_now_iso() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
-def get_connection() -> sqlite3.Connection:
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+DB_READERS = max(1, int(os.environ.get("VIPER_DB_READERS") or 4))
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_CACHE_KIB = 16 * 1024
+DB_STATEMENT_CACHE = 256
+
+def _configure(conn: sqlite3.Connection, readonly: bool) -> sqlite3.Connection:
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
+    conn.execute("PRAGMA busy_timeout = 5000;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE};")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KIB};")
+    # FTS triggers and backfills index plaintext through this, whatever the row's codec.
+    conn.create_function("viper_content", 2, decode_content, deterministic=True)
+    if readonly:
+        conn.execute("PRAGMA query_only = ON;")
     return conn
 
+def get_connection(readonly: bool = False) -> sqlite3.Connection:
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+    if not readonly:
+        # Only takes effect on a new database; maintenance can convert an old one with a full VACUUM.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        conn.execute("PRAGMA journal_mode = WAL;")
+    return _configure(conn, readonly)
+
+class ConnectionPool:
+    # One writer connection serialised by a lock plus a set of query-only readers.
+    # In WAL mode readers see the last committed snapshot and never wait on the writer.
+    def __init__(self, readers: int) -> None:
+        self._writer = get_connection()
+        self._writer_lock = threading.RLock()
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._reader_slots = threading.Semaphore(readers)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        with self._writer_lock:
+            yield self._writer
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        self._reader_slots.acquire()
+        try:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                conn = get_connection(readonly=True)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    def close(self) -> None:
+        with self._writer_lock:
+            self._writer.close()
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_READERS)
+    return _pool
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+def db_session(readonly: bool = False) -> ContextManager[sqlite3.Connection]:
+    # Latency is recorded per calling function, which is what /metrics labels as the site.
+    return _db_session(readonly, sys._getframe(1).f_code.co_name)
+
 @contextmanager
-def db_session() -> Iterator[sqlite3.Connection]:
-    conn = get_connection()
+def _db_session(readonly: bool, site: str) -> Iterator[sqlite3.Connection]:
+    pool = get_pool()
+    started = time.perf_counter()
     try:
-        yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
+        with span(f"db:{site}"):
+            if readonly:
+                with pool.reader() as conn:
+                    yield conn
+                return
+            with pool.writer() as conn:
+                try:
+                    yield conn
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
     finally:
-        conn.close()
-
-def init_db() -> None:
-    with db_session() as db:
-        db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS api_configs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                kind TEXT NOT NULL,
-                provider TEXT NOT NULL DEFAULT '',
-                base_url TEXT NOT NULL,
-                api_key TEXT,
-                model TEXT NOT NULL,
-                chat_completions_path TEXT NOT NULL DEFAULT '/v1/chat/completions',
-                extra_headers_json TEXT NOT NULL DEFAULT '{}',
-                temperature REAL NOT NULL DEFAULT 0.7,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL
-            );
-            """
-        )
-        db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS chat_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                api_config_id INTEGER,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                FOREIGN KEY(api_config_id) REFERENCES api_configs(id) ON DELETE SET NULL
-            );
-            """
-        )
-        db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                FOREIGN KEY(session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
-            );
-            """
-        )
-        db.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_session_id ON chat_messages(session_id);")
-        try:
-            cols = {r["name"] for r in db.execute("PRAGMA table_info(api_configs);").fetchall()}
-            if "update_at" in cols and "updated_at" not in cols:
-                db.execute("ALTER TABLE api_configs RENAME COLUMN update_at TO updated_at;")
-            if "provider" not in cols:
-                db.execute("ALTER TABLE api_configs ADD COLUMN provider TEXT NOT NULL DEFAULT '';")
-            if "chat_completions_path" not in cols:
-                db.execute(
-                    "ALTER TABLE api_configs ADD COLUMN chat_completions_path TEXT NOT NULL DEFAULT '/v1/chat/completions';"
-                )
-            if "temperature" not in cols:
-                db.execute("ALTER TABLE api_configs ADD COLUMN temperature REAL NOT NULL DEFAULT 0.7;")
-        except Exception:
-            pass
+        db_latency.observe(time.perf_counter() - started, site, "read" if readonly else "write")
+
+def get_meta(db: sqlite3.Connection, key: str) -> Optional[str]:
+    row = db.execute("SELECT value FROM viper_meta WHERE key = ?;", (key,)).fetchone()
+    return row["value"] if row else None
+
+def set_meta(db: sqlite3.Connection, key: str, value: Optional[str]) -> None:
+    if value is None:
+        db.execute("DELETE FROM viper_meta WHERE key = ?;", (key,))
+    else:
+        db.execute("INSERT INTO viper_meta(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value;", (key, value))
+
+FTS_BACKFILL_CHUNK = 2000
+
+def backfill_fts() -> None:
+    # The FTS triggers skip rows inside the pending range, so each id is indexed exactly once here.
+    while True:
+        with db_session() as db:
+            upto = get_meta(db, "fts_backfill_upto")
+            end = get_meta(db, "fts_backfill_end")
+            if upto is None or end is None:
+                return
+            lo, hi = int(upto), int(end)
+            row = db.execute(
+                "SELECT id FROM chat_messages WHERE id > ? AND id <= ? ORDER BY id LIMIT 1 OFFSET ?;",
+                (lo, hi, FTS_BACKFILL_CHUNK - 1),
+            ).fetchone()
+            stop = row["id"] if row else hi
+            db.execute(
+                """
+                INSERT INTO chat_messages_fts(rowid, content, session_id)
+                SELECT id, viper_content(content, codec), session_id FROM chat_messages
+                WHERE id > ? AND id <= ?;
+                """,
+                (lo, stop),
+            )
+            if stop >= hi:
+                set_meta(db, "fts_backfill_upto", None)
+                set_meta(db, "fts_backfill_end", None)
+                return
+            set_meta(db, "fts_backfill_upto", str(stop))
 
 def dumps_json_obj(value: Optional[Dict[str, Any]]) -> str:
     return json.dumps(value or {}, ensure_ascii=False, separators=(",", ":"))
@@ -127,6 +205,11 @@ def api_config_row(row: sqlite3.Row) -> Dict[str, Any]:
         "chat_completions_path": row["chat_completions_path"] if "chat_completions_path" in keys else "/v1/chat/completions",
         "extra_headers": loads_json_obj(row["extra_headers_json"] if "extra_headers_json" in keys else None),
         "temperature": float(row["temperature"]) if "temperature" in keys and row["temperature"] is not None else 0.7,
+        "context_tokens": int(row["context_tokens"] or 0) if "context_tokens" in keys else 0,
+        "context_strategy": row["context_strategy"] if "context_strategy" in keys else "window",
+        "max_concurrency": int(row["max_concurrency"] or 0) if "max_concurrency" in keys else 0,
+        "tokens_per_minute": int(row["tokens_per_minute"] or 0) if "tokens_per_minute" in keys else 0,
+        "pool": row["pool"] if "pool" in keys else "",
         "created_at": row["created_at"],
         "updated_at": updated_at,
     }
@@ -136,15 +219,40 @@ def session_row(row: sqlite3.Row) -> Dict[str, Any]:
         "id": row["id"],
         "title": row["title"],
         "api_config_id": row["api_config_id"],
+        "head_message_id": row["head_message_id"],
         "created_at": row["created_at"],
         "updated_at": row["updated_at"],
     }
 
-def message_row(row: sqlite3.Row) -> Dict[str, Any]:
+def message_row(row: sqlite3.Row, content: Optional[str] = None) -> Dict[str, Any]:
+    # Callers that just wrote the row pass the plaintext to skip decompressing it again.
     return {
         "id": row["id"],
         "session_id": row["session_id"],
         "role": row["role"],
-        "content": row["content"],
+        "content": content if content is not None else decode_content(row["content"], row["codec"]),
+        "token_count": row["token_count"],
+        "status": row["status"],
+        "api_config_id": row["api_config_id"],
+        "variant_of": row["variant_of"],
+        "parent_id": row["parent_id"],
         "created_at": row["created_at"],
     }
+
+def batch_job_row(row: sqlite3.Row, counts: Dict[str, int]) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "api_config_id": row["api_config_id"],
+        "status": row["status"],
+        "workers": row["workers"],
+        "temperature": row["temperature"],
+        "total": row["total"],
+        "pending": counts.get("pending", 0),
+        "running": counts.get("running", 0),
+        "complete": counts.get("complete", 0),
+        "failed": counts.get("failed", 0),
+        "cancelled": counts.get("cancelled", 0),
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
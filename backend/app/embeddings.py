@@ -0,0 +1,98 @@
+import os
+import re
+import zlib
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Local text embedders for retrieval. NumPy is imported on first use, so it costs
+# nothing at startup and nothing at all unless a config uses the retrieval strategy.
+# Every embedder returns L2-normalised float32 rows; `name` is stored next to each
+# vector, so switching embedders re-embeds instead of mixing vector spaces.
+EMBEDDER = os.environ.get("VIPER_EMBEDDER") or "hashing"
+EMBED_DIM = int(os.environ.get("VIPER_EMBED_DIM") or 512)
+
+WORD_RE = re.compile(r"\w+")
+
+class Embedder(ABC):
+    name = ""
+    dim = 0
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        ...
+
+    def reweight(self, docs: "np.ndarray", query: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+        # Hook for corpus statistics at query time; vectors are used as stored by default.
+        return docs, query
+
+EMBEDDERS: Dict[str, Callable[[], Embedder]] = {}
+
+def register_embedder(name: str) -> Callable[[Callable[[], Embedder]], Callable[[], Embedder]]:
+    def decorator(factory: Callable[[], Embedder]) -> Callable[[], Embedder]:
+        EMBEDDERS[name] = factory
+        return factory
+    return decorator
+
+def _features(text: str) -> List[str]:
+    # Words for space-separated scripts; CJK runs have no spaces, so they
+    # contribute overlapping character bigrams instead.
+    out: List[str] = []
+    for word in WORD_RE.findall(text.lower()):
+        if word.isascii() or len(word) == 1:
+            out.append(word)
+        else:
+            out.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return out
+
+class HashingEmbedder(Embedder):
+    # Feature hashing (signed, so collisions cancel rather than pile up) with
+    # log-scaled term frequency. reweight() applies IDF computed over the candidate
+    # rows, which turns the stored TF vectors into TF-IDF without a vocabulary.
+    def __init__(self, dim: int) -> None:
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: List[str]) -> "np.ndarray":
+        import numpy as np
+
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = [zlib.crc32(f.encode("utf-8")) for f in _features(text)]
+            if not hashes:
+                continue
+            h = np.array(hashes, dtype=np.uint32)
+            signs = np.where((h // self.dim) & 1, -1.0, 1.0)
+            counts = np.bincount(h % self.dim, weights=signs, minlength=self.dim)
+            out[row] = np.sign(counts) * np.log1p(np.abs(counts))
+        return _normalize(out)
+
+    def reweight(self, docs: "np.ndarray", query: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+        import numpy as np
+
+        df = np.count_nonzero(docs, axis=0)
+        idf = (np.log((1.0 + len(docs)) / (1.0 + df)) + 1.0).astype(np.float32)
+        return _normalize(docs * idf), _normalize((query * idf)[None, :])[0]
+
+def _normalize(m: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    return m / np.maximum(norms, 1e-12)
+
+@register_embedder("hashing")
+def _hashing() -> Embedder:
+    return HashingEmbedder(EMBED_DIM)
+
+_embedder: Optional[Embedder] = None
+
+def get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        factory = EMBEDDERS.get(EMBEDDER)
+        if factory is None:
+            raise RuntimeError(f"unknown embedder: {EMBEDDER}")
+        _embedder = factory()
+    return _embedder
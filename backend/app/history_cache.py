@@ -0,0 +1,82 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+HISTORY_CACHE_SESSIONS = int(os.environ.get("VIPER_HISTORY_CACHE_SESSIONS") or 256)
+
+class HistoryCache:
+    # LRU of per-session message lists. Every mutation bumps a global epoch so a
+    # reader that loaded rows from the DB only publishes them if nothing was
+    # appended or invalidated while it was reading.
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._entries: "OrderedDict[int, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id: int) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return list(entry)
+
+    def begin_load(self) -> int:
+        with self._lock:
+            return self._epoch
+
+    def fill(self, session_id: int, epoch: int, messages: List[Dict[str, Any]]) -> None:
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._epoch += 1
+            self._entries[session_id] = list(messages)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def append(self, session_id: int, messages: List[Dict[str, Any]]) -> None:
+        # Entries hold the session's active branch. A message that does not extend
+        # its tail did not become the head (see trg_chat_messages_touch_session),
+        # so the entry is dropped rather than guessed at.
+        with self._lock:
+            self._epoch += 1
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            if messages[0].get("parent_id") != (entry[-1]["id"] if entry else None):
+                del self._entries[session_id]
+                return
+            entry.extend(messages)
+
+    def invalidate(self, session_id: int) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(session_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+history_cache = HistoryCache(HISTORY_CACHE_SESSIONS)
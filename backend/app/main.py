@@ -1,8 +1,22 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 
-from . import api_configs, chat, sessions
-from .db import init_db
+from . import admin, api_configs, batches, chat, search, sessions, transfer
+from .balancer import balancer_stats
+from .coalesce import coalesce_stats
+from .completion_cache import completion_cache
+from .config_cache import config_cache
+from .db import close_pool
+from .history_cache import history_cache
+from .maintenance import maintenance_status, start_maintenance, stop_maintenance
+from .metrics import CallbackMetric, MetricsMiddleware, registry
+from .migrations import init_db
+from .retrieval import vector_index
+from .scheduler import scheduler_stats
+from .streams import active_generation_count, subscriber_count
+from .tracing import TracingMiddleware
+from .upstream import close_clients
 
 app = FastAPI(title="Viper Backend")
 
@@ -12,12 +26,50 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Generation-Id", "X-Viper-Cache", "X-Trace-Id", "Server-Timing"],
+)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+registry.register(CallbackMetric("viper_active_streams", "Generations currently producing.", "gauge", active_generation_count))
+registry.register(CallbackMetric("viper_stream_subscribers", "Open SSE responses attached to generations.", "gauge", subscriber_count))
+registry.register(
+    CallbackMetric(
+        "viper_coalesced_requests_total",
+        "Requests served by another request's in-flight upstream call.",
+        "counter",
+        lambda: {(kind,): v["coalesced"] for kind, v in coalesce_stats().items() if isinstance(v, dict)},
+        ("kind",),
+    )
+)
+registry.register(
+    CallbackMetric(
+        "viper_scheduler_queue_depth",
+        "Requests waiting for an upstream slot.",
+        "gauge",
+        lambda: {(k,): v["queue_depth"] for k, v in scheduler_stats().items()},
+        ("api_config",),
+    )
 )
 
 
 @app.on_event("startup")
 def _startup() -> None:
     init_db()
+    start_maintenance()
+
+
+@app.on_event("startup")
+async def _resume_batches() -> None:
+    await batches.resume_batches()
+
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    await batches.stop_batches()
+    await run_in_threadpool(stop_maintenance)
+    await close_clients()
+    close_pool()
 
 
 @app.get("/health")
@@ -25,6 +77,31 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/stats")
+def stats():
+    return {
+        "history_cache": history_cache.stats(),
+        "completion_cache": completion_cache.stats(),
+        "config_cache": config_cache.stats(),
+        "scheduler": scheduler_stats(),
+        "balancer": balancer_stats(),
+        "coalesce": coalesce_stats(),
+        "batches": {"running": batches.active_batch_count()},
+        "maintenance": maintenance_status(),
+        "retrieval": vector_index.stats(),
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
 app.include_router(api_configs.router)
+# /sessions/export and /sessions/import must match before /sessions/{session_id}.
+app.include_router(transfer.router)
 app.include_router(sessions.router)
 app.include_router(chat.router)
+app.include_router(search.router)
+app.include_router(batches.router)
+app.include_router(admin.router)
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+from .compression import CONTENT_COMPRESS_MIN_BYTES, encode_content
+from .db import db_session, get_meta, set_meta, utc_now_iso
+
+# Background upkeep on a timer: compress message bodies written before content
+# compression existed, hand free pages back to the filesystem and refresh the
+# planner statistics. Every step takes the writer in short slices so chat traffic
+# keeps flowing while it runs.
+MAINTENANCE_INTERVAL = float(os.environ.get("VIPER_MAINTENANCE_INTERVAL") or 3600)
+MAINTENANCE_DELAY = float(os.environ.get("VIPER_MAINTENANCE_DELAY") or 60)
+COMPACT_CHUNK = 500
+VACUUM_PAGES = 1000
+ANALYSIS_LIMIT = 1000
+
+_run_lock = threading.Lock()
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+_last_report: Optional[Dict[str, Any]] = None
+_last_error: Optional[str] = None
+
+def _space() -> Dict[str, int]:
+    with db_session(readonly=True) as db:
+        page_size = db.execute("PRAGMA page_size;").fetchone()[0]
+        page_count = db.execute("PRAGMA page_count;").fetchone()[0]
+        freelist = db.execute("PRAGMA freelist_count;").fetchone()[0]
+    return {"page_size": page_size, "page_count": page_count, "freelist_pages": freelist, "bytes": page_size * page_count}
+
+def _compact() -> Dict[str, int]:
+    rows = saved = 0
+    while not _stop.is_set():
+        with db_session() as db:
+            upto = int(get_meta(db, "compact_upto") or 0)
+            batch = db.execute(
+                """
+                SELECT id, content FROM chat_messages
+                WHERE id > ? AND codec = '' AND length(CAST(content AS BLOB)) >= ?
+                ORDER BY id LIMIT ?;
+                """,
+                (upto, CONTENT_COMPRESS_MIN_BYTES, COMPACT_CHUNK),
+            ).fetchall()
+            if not batch:
+                last = db.execute("SELECT MAX(id) FROM chat_messages;").fetchone()[0]
+                set_meta(db, "compact_upto", str(max(upto, last or 0)))
+                break
+            updates = []
+            for row in batch:
+                value, codec = encode_content(row["content"])
+                if codec:
+                    updates.append((value, codec, row["id"]))
+                    saved += len(row["content"].encode("utf-8")) - len(value)
+            db.executemany("UPDATE chat_messages SET content = ?, codec = ? WHERE id = ?;", updates)
+            rows += len(updates)
+            set_meta(db, "compact_upto", str(batch[-1]["id"]))
+    return {"rows_compressed": rows, "bytes_saved": saved}
+
+def _vacuum(full: bool) -> str:
+    with db_session() as db:
+        mode = db.execute("PRAGMA auto_vacuum;").fetchone()[0]
+        if full:
+            # Rewrites the whole file under the writer lock; also switches an old
+            # database (auto_vacuum=NONE) to incremental so later runs can shrink it.
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            db.execute("VACUUM;")
+            return "full"
+    if mode != 2:
+        return "skipped"
+    while not _stop.is_set():
+        with db_session() as db:
+            if not db.execute("PRAGMA freelist_count;").fetchone()[0]:
+                break
+            # Each result row is one freed page, so the cursor has to be drained.
+            db.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES});").fetchall()
+    return "incremental"
+
+def run_maintenance(full_vacuum: bool = False) -> Optional[Dict[str, Any]]:
+    global _last_report
+    if not _run_lock.acquire(blocking=False):
+        return None
+    try:
+        started = time.perf_counter()
+        before = _space()
+        compact = _compact()
+        vacuum = _vacuum(full_vacuum)
+        with db_session() as db:
+            db.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT};")
+            db.execute("ANALYZE;")
+            # Fold the WAL back in so the reclaimed pages show up as a smaller file.
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+        after = _space()
+        report = {
+            "finished_at": utc_now_iso(),
+            "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+            "vacuum": vacuum,
+            **compact,
+            "bytes_before": before["bytes"],
+            "bytes_after": after["bytes"],
+            "bytes_reclaimed": before["bytes"] - after["bytes"],
+            "freelist_pages": after["freelist_pages"],
+        }
+        with db_session() as db:
+            set_meta(db, "maintenance_last", json.dumps(report))
+        _last_report = report
+        return report
+    finally:
+        _run_lock.release()
+
+def maintenance_status() -> Dict[str, Any]:
+    global _last_report
+    if _last_report is None:
+        with db_session(readonly=True) as db:
+            value = get_meta(db, "maintenance_last")
+        _last_report = json.loads(value) if value else None
+    return {"running": _run_lock.locked(), "interval_s": MAINTENANCE_INTERVAL, "last": _last_report, "error": _last_error}
+
+def _loop() -> None:
+    global _last_error
+    if _stop.wait(MAINTENANCE_DELAY):
+        return
+    while True:
+        try:
+            run_maintenance()
+            _last_error = None
+        except Exception as e:
+            _last_error = str(e)
+        if _stop.wait(MAINTENANCE_INTERVAL):
+            return
+
+def start_maintenance() -> None:
+    global _thread
+    if MAINTENANCE_INTERVAL <= 0 or _thread is not None:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, name="viper-maintenance", daemon=True)
+    _thread.start()
+
+def stop_maintenance() -> None:
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=10)
+        _thread = None
@@ -0,0 +1,179 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Minimal Prometheus text-format metrics. Each update is a dict lookup plus a
+# couple of additions under a lock, cheap enough for the request and stream paths.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+RATE_BUCKETS = (1.0, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0, 320.0, 640.0)
+
+INF_LABEL = 'le="+Inf"'
+
+LabelValues = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        out: List[str] = []
+        for labels, row in items:
+            cumulative = 0.0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                le = 'le="%s"' % _number(bound)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {_number(cumulative)}")
+            cumulative += row[-2]
+            out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, INF_LABEL)} {_number(cumulative)}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(row[-1])}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {_number(cumulative)}")
+        return out
+
+class CallbackMetric(Metric):
+    # Read at scrape time from state the app keeps anyway (active streams, cache counters).
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], Any], labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self._fn = fn
+
+    def samples(self) -> List[str]:
+        value = self._fn()
+        if not isinstance(value, dict):
+            return [f"{self.name} {_number(value)}"]
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in value.items()]
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+registry = Registry()
+
+http_requests = registry.register(Counter("viper_http_requests_total", "HTTP requests by route and status.", ("method", "route", "status")))
+http_latency = registry.register(Histogram("viper_http_request_duration_seconds", "HTTP request duration until the response body completes.", ("method", "route")))
+upstream_ttft = registry.register(Histogram("viper_upstream_ttft_seconds", "Time from dispatching a streamed request (including scheduler wait) to its first body chunk.", ("api_config", "model")))
+upstream_generation = registry.register(Histogram("viper_upstream_generation_seconds", "Total upstream generation time.", ("api_config", "model", "status")))
+upstream_tokens_per_second = registry.register(
+    Histogram("viper_upstream_tokens_per_second", "Estimated output tokens per second after the first byte.", ("api_config", "model"), RATE_BUCKETS)
+)
+upstream_errors = registry.register(Counter("viper_upstream_errors_total", "Upstream errors by type.", ("api_config", "type")))
+db_latency = registry.register(Histogram("viper_db_session_seconds", "Time inside db_session, including lock waits, by call site.", ("site", "mode"), DB_BUCKETS))
+
+class UpstreamTimer:
+    __slots__ = ("labels", "started", "first")
+
+    def __init__(self, cfg: Dict[str, Any]) -> None:
+        self.labels = (str(cfg["id"]), cfg["model"])
+        self.started = time.perf_counter()
+        self.first: Optional[float] = None
+
+    def first_byte(self) -> None:
+        if self.first is None:
+            self.first = time.perf_counter()
+            upstream_ttft.observe(self.first - self.started, *self.labels)
+
+    def finish(self, tokens: int, status: str) -> None:
+        now = time.perf_counter()
+        upstream_generation.observe(now - self.started, *self.labels, status)
+        if self.first is not None and now > self.first and tokens:
+            upstream_tokens_per_second.observe(tokens / (now - self.first), *self.labels)
+
+def upstream_error(cfg: Dict[str, Any], kind: str) -> None:
+    upstream_errors.inc(str(cfg["id"]), kind)
+
+class MetricsMiddleware:
+    # Plain ASGI middleware so streaming bodies pass through untouched.
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            http_requests.inc(scope["method"], path, str(status[0]))
+            http_latency.observe(time.perf_counter() - started, scope["method"], path)
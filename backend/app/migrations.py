@@ -0,0 +1,355 @@
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from .db import backfill_fts, db_session, set_meta
+
+# Schema changes are numbered steps recorded in PRAGMA user_version. Each step runs
+# in its own write transaction together with the version bump, so a failure rolls
+# that step back and propagates instead of leaving a half-migrated file. Steps stay
+# idempotent (IF NOT EXISTS, column probes) because databases from before
+# versioning start at 0 with some of the schema already in place. Append new steps;
+# never edit one that has shipped.
+
+def _add_columns(db: sqlite3.Connection, table: str, columns: Dict[str, str]) -> None:
+    existing = {r["name"] for r in db.execute(f"PRAGMA table_info({table});").fetchall()}
+    for name, ddl in columns.items():
+        if name not in existing:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl};")
+
+def _core(db: sqlite3.Connection) -> None:
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS api_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            provider TEXT NOT NULL DEFAULT '',
+            base_url TEXT NOT NULL,
+            api_key TEXT,
+            model TEXT NOT NULL,
+            chat_completions_path TEXT NOT NULL DEFAULT '/v1/chat/completions',
+            extra_headers_json TEXT NOT NULL DEFAULT '{}',
+            temperature REAL NOT NULL DEFAULT 0.7,
+            context_tokens INTEGER NOT NULL DEFAULT 0,
+            context_strategy TEXT NOT NULL DEFAULT 'window',
+            max_concurrency INTEGER NOT NULL DEFAULT 0,
+            tokens_per_minute INTEGER NOT NULL DEFAULT 0,
+            pool TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            api_config_id INTEGER,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            FOREIGN KEY(api_config_id) REFERENCES api_configs(id) ON DELETE SET NULL
+        );
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            token_count INTEGER,
+            status TEXT NOT NULL DEFAULT 'complete',
+            api_config_id INTEGER,
+            variant_of INTEGER,
+            codec TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE
+        );
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_session_id ON chat_messages(session_id);")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated_at ON chat_sessions(updated_at, id);")
+    db.execute("CREATE TABLE IF NOT EXISTS viper_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);")
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS completion_cache (
+            key TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_completion_cache_created_at ON completion_cache(created_at);")
+    db.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_chat_messages_touch_session AFTER INSERT ON chat_messages
+        BEGIN
+            UPDATE chat_sessions SET updated_at = NEW.created_at WHERE id = NEW.session_id;
+        END;
+        """
+    )
+    cols = {r["name"] for r in db.execute("PRAGMA table_info(api_configs);").fetchall()}
+    if "update_at" in cols and "updated_at" not in cols:
+        db.execute("ALTER TABLE api_configs RENAME COLUMN update_at TO updated_at;")
+    _add_columns(
+        db,
+        "api_configs",
+        {
+            "provider": "TEXT NOT NULL DEFAULT ''",
+            "chat_completions_path": "TEXT NOT NULL DEFAULT '/v1/chat/completions'",
+            "temperature": "REAL NOT NULL DEFAULT 0.7",
+            "context_tokens": "INTEGER NOT NULL DEFAULT 0",
+            "context_strategy": "TEXT NOT NULL DEFAULT 'window'",
+            "max_concurrency": "INTEGER NOT NULL DEFAULT 0",
+            "tokens_per_minute": "INTEGER NOT NULL DEFAULT 0",
+            "pool": "TEXT NOT NULL DEFAULT ''",
+        },
+    )
+    _add_columns(
+        db,
+        "chat_messages",
+        {
+            "token_count": "INTEGER",
+            "status": "TEXT NOT NULL DEFAULT 'complete'",
+            "api_config_id": "INTEGER",
+            "variant_of": "INTEGER",
+            "codec": "TEXT NOT NULL DEFAULT ''",
+        },
+    )
+
+def _search_index(db: sqlite3.Connection) -> None:
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_messages_fts';").fetchone()
+    if not exists:
+        # trigram gives substring matching for CJK text; older SQLite builds fall back to unicode61.
+        try:
+            db.execute("CREATE VIRTUAL TABLE chat_messages_fts USING fts5(content, session_id UNINDEXED, tokenize='trigram');")
+            set_meta(db, "fts_tokenizer", "trigram")
+        except sqlite3.OperationalError:
+            db.execute("CREATE VIRTUAL TABLE chat_messages_fts USING fts5(content, session_id UNINDEXED, tokenize='unicode61 remove_diacritics 2');")
+            set_meta(db, "fts_tokenizer", "unicode61")
+        # Rows up to the current max id are indexed in the background; triggers cover the rest.
+        end = db.execute("SELECT COALESCE(MAX(id), 0) AS m FROM chat_messages;").fetchone()["m"]
+        if end:
+            set_meta(db, "fts_backfill_upto", "0")
+            set_meta(db, "fts_backfill_end", str(end))
+    # Drop first: databases from before content compression have triggers that index the raw column.
+    for name in ("trg_chat_messages_fts_insert", "trg_chat_messages_fts_delete", "trg_chat_messages_fts_update"):
+        db.execute(f"DROP TRIGGER IF EXISTS {name};")
+    db.execute(
+        """
+        CREATE TRIGGER trg_chat_messages_fts_insert AFTER INSERT ON chat_messages
+        BEGIN
+            INSERT INTO chat_messages_fts(rowid, content, session_id) VALUES (NEW.id, viper_content(NEW.content, NEW.codec), NEW.session_id);
+        END;
+        """
+    )
+    db.execute(
+        """
+        CREATE TRIGGER trg_chat_messages_fts_delete AFTER DELETE ON chat_messages
+        BEGIN
+            DELETE FROM chat_messages_fts WHERE rowid = OLD.id;
+        END;
+        """
+    )
+    db.execute(
+        """
+        CREATE TRIGGER trg_chat_messages_fts_update AFTER UPDATE OF content ON chat_messages
+        WHEN viper_content(NEW.content, NEW.codec) IS NOT viper_content(OLD.content, OLD.codec)
+        BEGIN
+            DELETE FROM chat_messages_fts WHERE rowid = OLD.id;
+            INSERT INTO chat_messages_fts(rowid, content, session_id) VALUES (NEW.id, viper_content(NEW.content, NEW.codec), NEW.session_id);
+        END;
+        """
+    )
+
+def _batches(db: sqlite3.Connection) -> None:
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            api_config_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            workers INTEGER NOT NULL,
+            temperature REAL NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            custom_id TEXT,
+            messages_json TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            content TEXT,
+            response_json TEXT,
+            error TEXT,
+            FOREIGN KEY(job_id) REFERENCES batch_jobs(id) ON DELETE CASCADE
+        );
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_batch_items_job_status ON batch_items(job_id, status, id);")
+
+def _message_tree(db: sqlite3.Connection) -> None:
+    # Messages form a tree per session and chat_sessions.head_message_id marks the
+    # active branch. Existing history becomes one chain; fan-out answers (variant_of)
+    # become siblings under the user message they answer, the first one on the chain.
+    _add_columns(db, "chat_messages", {"parent_id": "INTEGER"})
+    _add_columns(db, "chat_sessions", {"head_message_id": "INTEGER"})
+    db.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_parent_id ON chat_messages(parent_id);")
+    rows = db.execute("SELECT id, session_id, variant_of FROM chat_messages WHERE parent_id IS NULL ORDER BY session_id, id;").fetchall()
+    parents: List[Tuple[int, int]] = []
+    heads: List[Tuple[int, int]] = []
+    session: Optional[int] = None
+    tail: Optional[int] = None
+    groups: Set[int] = set()
+    for row in rows:
+        if row["session_id"] != session:
+            if tail is not None:
+                heads.append((tail, session))
+            session, tail = row["session_id"], None
+            groups.clear()
+        variant_of = row["variant_of"]
+        parent = tail if variant_of is None else variant_of
+        if variant_of is None or variant_of not in groups:
+            tail = row["id"]
+            if variant_of is not None:
+                groups.add(variant_of)
+        if parent is not None:
+            parents.append((parent, row["id"]))
+    if tail is not None:
+        heads.append((tail, session))
+    db.executemany("UPDATE chat_messages SET parent_id = ? WHERE id = ?;", parents)
+    db.executemany("UPDATE chat_sessions SET head_message_id = ? WHERE id = ? AND head_message_id IS NULL;", heads)
+    # A new message only becomes the head when it extends the current head, so
+    # replies landing on a branch the user has since left do not switch it back.
+    db.execute("DROP TRIGGER IF EXISTS trg_chat_messages_touch_session;")
+    db.execute(
+        """
+        CREATE TRIGGER trg_chat_messages_touch_session AFTER INSERT ON chat_messages
+        BEGIN
+            UPDATE chat_sessions
+            SET updated_at = NEW.created_at,
+                head_message_id = CASE WHEN head_message_id IS NEW.parent_id THEN NEW.id ELSE head_message_id END
+            WHERE id = NEW.session_id;
+        END;
+        """
+    )
+
+def _message_embeddings(db: sqlite3.Connection) -> None:
+    # Filled lazily by the retrieval context strategy; model names the embedder and its dimension.
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_message_embeddings (
+            message_id INTEGER PRIMARY KEY,
+            session_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            FOREIGN KEY(message_id) REFERENCES chat_messages(id) ON DELETE CASCADE
+        );
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_chat_message_embeddings_session ON chat_message_embeddings(session_id, model);")
+
+# Rows in (fts_backfill_upto, fts_backfill_end] are not in the index yet; the
+# background backfill owns them, so the triggers leave them alone.
+FTS_PENDING = """
+    EXISTS (
+        SELECT 1 FROM viper_meta u JOIN viper_meta e ON e.key = 'fts_backfill_end'
+        WHERE u.key = 'fts_backfill_upto' AND OLD.id > CAST(u.value AS INTEGER) AND OLD.id <= CAST(e.value AS INTEGER)
+    )
+"""
+
+def _external_search_index(db: sqlite3.Connection) -> None:
+    # The index used to keep its own plaintext copy of every message, which undid
+    # content compression. It now reads content through a view that decodes
+    # chat_messages, so only the inverted index is stored. External-content deletes
+    # must pass the indexed values, hence the 'delete' commands in the triggers.
+    for name in ("trg_chat_messages_fts_insert", "trg_chat_messages_fts_delete", "trg_chat_messages_fts_update"):
+        db.execute(f"DROP TRIGGER IF EXISTS {name};")
+    db.execute("DROP TABLE IF EXISTS chat_messages_fts;")
+    db.execute(
+        """
+        CREATE VIEW IF NOT EXISTS chat_messages_fts_source AS
+        SELECT id, viper_content(content, codec) AS content, session_id FROM chat_messages;
+        """
+    )
+    fts = "CREATE VIRTUAL TABLE chat_messages_fts USING fts5(content, session_id UNINDEXED, content='chat_messages_fts_source', content_rowid='id', tokenize='{}');"
+    try:
+        db.execute(fts.format("trigram"))
+        set_meta(db, "fts_tokenizer", "trigram")
+    except sqlite3.OperationalError:
+        db.execute(fts.format("unicode61 remove_diacritics 2"))
+        set_meta(db, "fts_tokenizer", "unicode61")
+    end = db.execute("SELECT COALESCE(MAX(id), 0) AS m FROM chat_messages;").fetchone()["m"]
+    set_meta(db, "fts_backfill_upto", "0" if end else None)
+    set_meta(db, "fts_backfill_end", str(end) if end else None)
+    db.execute(
+        """
+        CREATE TRIGGER trg_chat_messages_fts_insert AFTER INSERT ON chat_messages
+        BEGIN
+            INSERT INTO chat_messages_fts(rowid, content, session_id) VALUES (NEW.id, viper_content(NEW.content, NEW.codec), NEW.session_id);
+        END;
+        """
+    )
+    db.execute(
+        f"""
+        CREATE TRIGGER trg_chat_messages_fts_delete AFTER DELETE ON chat_messages
+        WHEN NOT {FTS_PENDING}
+        BEGIN
+            INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, session_id)
+            VALUES ('delete', OLD.id, viper_content(OLD.content, OLD.codec), OLD.session_id);
+        END;
+        """
+    )
+    db.execute(
+        f"""
+        CREATE TRIGGER trg_chat_messages_fts_update AFTER UPDATE OF content ON chat_messages
+        WHEN viper_content(NEW.content, NEW.codec) IS NOT viper_content(OLD.content, OLD.codec) AND NOT {FTS_PENDING}
+        BEGIN
+            INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, session_id)
+            VALUES ('delete', OLD.id, viper_content(OLD.content, OLD.codec), OLD.session_id);
+            INSERT INTO chat_messages_fts(rowid, content, session_id) VALUES (NEW.id, viper_content(NEW.content, NEW.codec), NEW.session_id);
+        END;
+        """
+    )
+
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _core,
+    _search_index,
+    _batches,
+    _message_tree,
+    _message_embeddings,
+    _external_search_index,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(db: sqlite3.Connection) -> int:
+    # Returns the number of steps applied; 0 means the schema was already current.
+    version = db.execute("PRAGMA user_version;").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"database schema version {version} is newer than this build supports ({SCHEMA_VERSION})")
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        db.execute("BEGIN IMMEDIATE;")
+        try:
+            MIGRATIONS[target - 1](db)
+            db.execute(f"PRAGMA user_version = {target};")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return SCHEMA_VERSION - version
+
+def init_db() -> None:
+    with db_session() as db:
+        migrate(db)
+    threading.Thread(target=backfill_fts, name="viper-fts-backfill", daemon=True).start()
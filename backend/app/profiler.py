@@ -0,0 +1,100 @@
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+PROFILE_DEFAULT_INTERVAL = 0.005
+PROFILE_MAX_STACK = 128
+
+class SamplingProfiler:
+    # Armed for the next N requests: while any of them is in flight a daemon thread
+    # samples every thread's stack with sys._current_frames and counts folded
+    # stacks ("outer;inner;leaf count"), the input format of flamegraph.pl and
+    # speedscope. Sampling is process-wide, so concurrent requests show up too.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._remaining = 0
+        self._active = 0
+        self._interval = PROFILE_DEFAULT_INTERVAL
+        self._thread: Optional[threading.Thread] = None
+        self._stacks: "Counter[str]" = Counter()
+        self._samples = 0
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+        self._requests = 0
+
+    def arm(self, requests: int, interval: float) -> None:
+        with self._lock:
+            self._remaining = requests
+            self._interval = interval
+            self._stacks = Counter()
+            self._samples = 0
+            self._requests = 0
+            self._started_at = None
+            self._finished_at = None
+
+    def request_started(self) -> bool:
+        if not self._remaining:
+            return False
+        with self._lock:
+            if not self._remaining:
+                return False
+            self._remaining -= 1
+            self._active += 1
+            self._requests += 1
+            if self._started_at is None:
+                self._started_at = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_loop, name="viper-profiler", daemon=True)
+                self._thread.start()
+            return True
+
+    def request_finished(self) -> None:
+        with self._lock:
+            self._active -= 1
+            if not self._active and not self._remaining:
+                self._finished_at = time.time()
+
+    def _sample_loop(self) -> None:
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                interval = self._interval
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                names = []
+                while frame is not None and len(names) < PROFILE_MAX_STACK:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(names)))
+            with self._lock:
+                self._stacks.update(stacks)
+                self._samples += 1
+            time.sleep(interval)
+
+    def folded(self) -> str:
+        with self._lock:
+            items = self._stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "remaining_requests": self._remaining,
+                "active_requests": self._active,
+                "profiled_requests": self._requests,
+                "interval_ms": round(self._interval * 1000, 3),
+                "samples": self._samples,
+                "stacks": len(self._stacks),
+                "started_at": self._started_at,
+                "finished_at": self._finished_at,
+            }
+
+profiler = SamplingProfiler()
@@ -0,0 +1,123 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, List
+from .db import db_session
+from .embeddings import EMBEDDER, Embedder, get_embedder
+
+if TYPE_CHECKING:
+    import numpy as np
+
+RETRIEVAL_CACHE_SESSIONS = int(os.environ.get("VIPER_RETRIEVAL_CACHE_SESSIONS") or 32)
+
+class _SessionVectors:
+    # Every embedded message of one session as rows of a float32 matrix that
+    # grows by doubling, so appending a turn's messages does not copy the rest.
+    def __init__(self, model: str, dim: int) -> None:
+        import numpy as np
+
+        self.model = model
+        self.positions: Dict[int, int] = {}
+        self.vectors = np.zeros((64, dim), dtype=np.float32)
+
+    def add(self, ids: List[int], vectors: "np.ndarray") -> None:
+        import numpy as np
+
+        fresh = [i for i, message_id in enumerate(ids) if message_id not in self.positions]
+        if not fresh:
+            return
+        size = len(self.positions)
+        needed = size + len(fresh)
+        if needed > len(self.vectors):
+            grown = np.zeros((max(needed, 2 * len(self.vectors)), self.vectors.shape[1]), dtype=np.float32)
+            grown[:size] = self.vectors[:size]
+            self.vectors = grown
+        self.vectors[size:needed] = vectors[fresh]
+        for offset, i in enumerate(fresh):
+            self.positions[ids[i]] = size + offset
+
+class VectorIndex:
+    # Per-session vectors are read from chat_message_embeddings once, then kept
+    # in an LRU and extended as new messages get embedded. Vectors are stored as
+    # raw float32 blobs, dim * 4 bytes each.
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._entries: "OrderedDict[int, _SessionVectors]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.embedded = 0
+        self.loaded = 0
+
+    def _load(self, session_id: int, embedder: Embedder) -> _SessionVectors:
+        import numpy as np
+
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry.model == embedder.name:
+                self._entries.move_to_end(session_id)
+                return entry
+        entry = _SessionVectors(embedder.name, embedder.dim)
+        with db_session(readonly=True) as db:
+            rows = db.execute(
+                "SELECT message_id, vector FROM chat_message_embeddings WHERE session_id = ? AND model = ?;",
+                (session_id, embedder.name),
+            ).fetchall()
+        if rows:
+            blob = b"".join(r["vector"] for r in rows)
+            entry.add([r["message_id"] for r in rows], np.frombuffer(blob, dtype=np.float32).reshape(len(rows), embedder.dim))
+        with self._lock:
+            self.loaded += len(rows)
+            if self.capacity > 0:
+                self._entries[session_id] = entry
+                self._entries.move_to_end(session_id)
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def _embed_missing(self, session_id: int, entry: _SessionVectors, embedder: Embedder, messages: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            missing = [m for m in messages if m["id"] not in entry.positions]
+        if not missing:
+            return
+        vectors = embedder.embed([m["content"] for m in missing])
+        with db_session() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO chat_message_embeddings(message_id, session_id, model, vector) VALUES(?,?,?,?);",
+                [(m["id"], session_id, embedder.name, v.tobytes()) for m, v in zip(missing, vectors)],
+            )
+        with self._lock:
+            entry.add([m["id"] for m in missing], vectors)
+            self.embedded += len(missing)
+
+    def search(self, session_id: int, query: str, candidates: List[Dict[str, Any]], k: int) -> List[Dict[str, Any]]:
+        # Candidates ranked by cosine similarity to the query, best first; messages
+        # without an embedding yet are embedded and stored on the way.
+        import numpy as np
+
+        if not candidates or k <= 0:
+            return []
+        embedder = get_embedder()
+        entry = self._load(session_id, embedder)
+        self._embed_missing(session_id, entry, embedder, candidates)
+        with self._lock:
+            self.searches += 1
+            docs = entry.vectors[[entry.positions[m["id"]] for m in candidates]]
+        docs, q = embedder.reweight(docs, embedder.embed([query])[0])
+        scores = docs @ q
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [candidates[i] for i in top if scores[i] > 0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "embedder": EMBEDDER,
+                "sessions": len(self._entries),
+                "capacity": self.capacity,
+                "searches": self.searches,
+                "embedded": self.embedded,
+                "loaded": self.loaded,
+            }
+
+vector_index = VectorIndex(RETRIEVAL_CACHE_SESSIONS)
@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+
+SCHEDULER_MAX_QUEUE = int(os.environ.get("VIPER_SCHEDULER_MAX_QUEUE") or 256)
+SCHEDULER_MAX_RETRY_WAIT = float(os.environ.get("VIPER_SCHEDULER_MAX_RETRY_WAIT") or 30)
+SCHEDULER_MAX_RETRIES = 2
+DEFAULT_RETRY_AFTER = 5.0
+TPM_WINDOW = 60.0
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+def parse_retry_after(value: Optional[str]) -> float:
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return DEFAULT_RETRY_AFTER
+
+class Slot:
+    def __init__(self, limiter: "ConfigLimiter") -> None:
+        self._limiter: Optional[ConfigLimiter] = limiter
+        # The api_config that holds the permit; for pools, the member that answered.
+        self.api_config_id = limiter.api_config_id
+        self.on_release: List[Callable[[], None]] = []
+
+    def release(self, tokens: int = 0) -> None:
+        if self._limiter is not None:
+            limiter, self._limiter = self._limiter, None
+            limiter._release(tokens)
+            for callback in self.on_release:
+                callback()
+
+class ConfigLimiter:
+    # Admission control for one api_config: at most max_concurrency upstream calls
+    # in flight, at most tokens_per_minute estimated tokens per rolling minute, and
+    # a bounded priority queue (interactive before batch, FIFO within a priority).
+    def __init__(self, api_config_id: int) -> None:
+        self.api_config_id = api_config_id
+        self.max_concurrency = 0
+        self.tokens_per_minute = 0
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._queue: List[Tuple[int, int, int, float, "asyncio.Future[None]"]] = []
+        self._seq = itertools.count()
+        self._window: Deque[Tuple[float, int]] = deque()
+        self._window_tokens = 0
+        self._wake: Optional[asyncio.TimerHandle] = None
+        self._wake_at = 0.0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def configure(self, cfg: Dict[str, Any]) -> None:
+        self.max_concurrency = int(cfg.get("max_concurrency") or 0)
+        self.tokens_per_minute = int(cfg.get("tokens_per_minute") or 0)
+
+    async def acquire(self, cost: int, priority: str = "interactive") -> Slot:
+        # Cancelled waiters stay in the heap until they reach the top, so the bound
+        # counts pending waiters rather than heap entries.
+        if self.waiting >= SCHEDULER_MAX_QUEUE:
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="upstream queue is full", headers={"Retry-After": "1"})
+        loop = asyncio.get_running_loop()
+        fut: "asyncio.Future[None]" = loop.create_future()
+        enqueued = loop.time()
+        self.waiting += 1
+        fut.add_done_callback(self._waiter_done)
+        if len(self._queue) > 2 * self.waiting + 16:
+            self._queue = [entry for entry in self._queue if not entry[4].done()]
+            heapq.heapify(self._queue)
+        heapq.heappush(self._queue, (PRIORITIES.get(priority, 0), next(self._seq), cost, enqueued, fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release(0)
+            raise
+        waited = loop.time() - enqueued
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return Slot(self)
+
+    def _waiter_done(self, fut: "asyncio.Future[None]") -> None:
+        self.waiting -= 1
+
+    def rate_limit(self, retry_after: float) -> None:
+        self.rate_limited += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def _release(self, tokens: int) -> None:
+        self.in_flight -= 1
+        if tokens:
+            self._charge(tokens)
+        self._dispatch()
+
+    def _charge(self, tokens: int) -> None:
+        self._window.append((time.monotonic(), tokens))
+        self._window_tokens += tokens
+
+    def _dispatch(self) -> None:
+        now = time.monotonic()
+        while self._window and self._window[0][0] <= now - TPM_WINDOW:
+            self._window_tokens -= self._window.popleft()[1]
+        retry_at = 0.0
+        while self._queue:
+            _, _, cost, _, fut = self._queue[0]
+            if fut.done():
+                heapq.heappop(self._queue)
+                continue
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                break
+            if self.paused_until > now:
+                retry_at = self.paused_until
+                break
+            # A single request larger than the whole budget still runs once the window is empty.
+            if self.tokens_per_minute and self._window and self._window_tokens + cost > self.tokens_per_minute:
+                retry_at = self._window[0][0] + TPM_WINDOW
+                break
+            heapq.heappop(self._queue)
+            self.in_flight += 1
+            self.admitted += 1
+            self._charge(cost)
+            fut.set_result(None)
+        # An earlier retry_at (e.g. a shorter Retry-After) replaces a later pending wake-up.
+        if retry_at and (self._wake is None or retry_at < self._wake_at):
+            if self._wake is not None:
+                self._wake.cancel()
+            def wake() -> None:
+                self._wake = None
+                self._dispatch()
+            self._wake_at = retry_at
+            self._wake = asyncio.get_running_loop().call_later(max(0.0, retry_at - now), wake)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = self.admitted or 1
+        return {
+            "max_concurrency": self.max_concurrency,
+            "tokens_per_minute": self.tokens_per_minute,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "window_tokens": self._window_tokens,
+            "paused_for": max(0.0, round(self.paused_until - time.monotonic(), 3)),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+            "wait_avg_ms": round(self.wait_total / waits * 1000, 3),
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+_limiters: Dict[int, ConfigLimiter] = {}
+
+def get_limiter(cfg: Dict[str, Any]) -> ConfigLimiter:
+    limiter = _limiters.get(cfg["id"])
+    if limiter is None:
+        limiter = _limiters[cfg["id"]] = ConfigLimiter(cfg["id"])
+    limiter.configure(cfg)
+    return limiter
+
+def scheduler_stats() -> Dict[str, Any]:
+    return {str(k): v.stats() for k, v in _limiters.items()}
@@ -2,6 +2,7 @@ from typing import Any, Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
 
 Role = Literal["system", "user", "assistant"]
+Priority = Literal["interactive", "batch"]
 
 class ApiConfigCreate(BaseModel):
     name: str
@@ -13,6 +14,11 @@ class ApiConfigCreate(BaseModel):
     chat_completions_path: str = Field(default="/v1/chat/completions")
     extra_headers: Dict[str, Any] = Field(default_factory=dict)
     temperature: float = Field(default=0.7)
+    context_tokens: int = Field(default=0, ge=0)
+    context_strategy: str = Field(default="window")
+    max_concurrency: int = Field(default=0, ge=0)
+    tokens_per_minute: int = Field(default=0, ge=0)
+    pool: str = Field(default="")
 
 class ApiConfigUpdate(BaseModel):
     name: Optional[str] = None
@@ -24,6 +30,11 @@ class ApiConfigUpdate(BaseModel):
     chat_completions_path: Optional[str] = None
     extra_headers: Optional[Dict[str, Any]] = None
     temperature: Optional[float] = None
+    context_tokens: Optional[int] = Field(default=None, ge=0)
+    context_strategy: Optional[str] = None
+    max_concurrency: Optional[int] = Field(default=None, ge=0)
+    tokens_per_minute: Optional[int] = Field(default=None, ge=0)
+    pool: Optional[str] = None
 
 class ApiConfigOut(BaseModel):
     id: int
@@ -36,6 +47,11 @@ class ApiConfigOut(BaseModel):
     chat_completions_path: str
     extra_headers: Dict[str, Any]
     temperature: float
+    context_tokens: int
+    context_strategy: str
+    max_concurrency: int
+    tokens_per_minute: int
+    pool: str
     created_at: str
     updated_at: str
 
@@ -47,6 +63,7 @@ class SessionOut(BaseModel):
     id: int
     title: str
     api_config_id: Optional[int] = None
+    head_message_id: Optional[int] = None
     created_at: str
     updated_at: str
 
@@ -57,26 +74,78 @@ class SessionUpdate(BaseModel):
 class MessageCreate(BaseModel):
     role: Role
     content: str
+    parent_message_id: Optional[int] = None
 
 class MessageOut(BaseModel):
     id: int
     session_id: int
     role: Role
     content: str
+    token_count: Optional[int] = None
+    status: str = "complete"
+    api_config_id: Optional[int] = None
+    variant_of: Optional[int] = None
+    parent_id: Optional[int] = None
     created_at: str
 
+class CheckoutRequest(BaseModel):
+    message_id: int
+
 class SessionWithMessages(BaseModel):
     session: SessionOut
     messages: List[MessageOut]
+    has_more: bool = False
 
 class ChatRequest(BaseModel):
     session_id: int
     api_config_id: Optional[int] = None
+    # Omit user_content to regenerate the reply to parent_message_id (or to the head).
+    user_content: Optional[str] = None
+    parent_message_id: Optional[int] = None
+    system_prompt: Optional[str] = None
+    temperature: float = 0.7
+    cache: bool = False
+    priority: Priority = "interactive"
+
+class FanoutRequest(BaseModel):
+    session_id: int
+    api_config_ids: List[int] = Field(min_length=1)
     user_content: str
+    parent_message_id: Optional[int] = None
     system_prompt: Optional[str] = None
     temperature: float = 0.7
+    priority: Priority = "interactive"
+
+class BatchOut(BaseModel):
+    id: int
+    api_config_id: int
+    status: str
+    workers: int
+    temperature: float
+    total: int
+    pending: int
+    running: int
+    complete: int
+    failed: int
+    cancelled: int = 0
+    error: Optional[str] = None
+    created_at: str
+    updated_at: str
 
 class ChatResponse(BaseModel):
     session_id: int
     assistant_content: str
     raw: Dict[str, Any]
+
+class SearchHit(BaseModel):
+    message_id: int
+    session_id: int
+    session_title: str
+    role: Role
+    snippet: str
+    score: float
+    created_at: str
+
+class SearchResults(BaseModel):
+    hits: List[SearchHit]
+    next_offset: Optional[int] = None
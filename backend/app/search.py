@@ -0,0 +1,79 @@
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, HTTPException, Query
+from .db import db_session, get_meta
+from .schemas import SearchResults
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+SNIPPET_TOKENS = 16
+SNIPPET_CHARS = 80
+TRIGRAM_MIN_CHARS = 3
+
+def _fts_phrase(q: str) -> str:
+    return '"' + q.replace('"', '""') + '"'
+
+def _like_pattern(q: str) -> str:
+    return "%" + q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _plain_snippet(content: str, q: str) -> str:
+    pos = content.lower().find(q.lower())
+    if pos < 0:
+        return content[:SNIPPET_CHARS]
+    start = max(0, pos - SNIPPET_CHARS // 2)
+    end = pos + len(q) + SNIPPET_CHARS // 2
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(content) else ""
+    return f"{prefix}{content[start:pos]}**{content[pos:pos + len(q)]}**{content[pos + len(q):end]}{suffix}"
+
+@router.get("", response_model=SearchResults)
+def search_messages(
+    q: str = Query(min_length=1),
+    session_id: Optional[int] = None,
+    limit: int = Query(default=20, ge=1, le=100),
+    offset: int = Query(default=0, ge=0),
+) -> Dict[str, Any]:
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="q must not be blank")
+    session_filter = " AND f.session_id = ?" if session_id is not None else ""
+    with db_session(readonly=True) as db:
+        short = get_meta(db, "fts_tokenizer") == "trigram" and len(q) < TRIGRAM_MIN_CHARS
+        if short:
+            # trigram cannot index fewer than three characters, so scan the FTS copy instead.
+            params: List[Any] = [_like_pattern(q)]
+            where = "f.content LIKE ? ESCAPE '\\'"
+            order = "f.rowid DESC"
+            columns = "f.content AS snippet, 0.0 AS score"
+        else:
+            params = [_fts_phrase(q)]
+            where = "chat_messages_fts MATCH ?"
+            order = "score"
+            columns = f"snippet(chat_messages_fts, 0, '**', '**', '…', {SNIPPET_TOKENS}) AS snippet, bm25(chat_messages_fts) AS score"
+        if session_id is not None:
+            params.append(session_id)
+        params += [limit + 1, offset]
+        rows = db.execute(
+            f"""
+            SELECT f.rowid AS message_id, m.session_id, s.title AS session_title, m.role, m.created_at, {columns}
+            FROM chat_messages_fts f
+            JOIN chat_messages m ON m.id = f.rowid
+            JOIN chat_sessions s ON s.id = m.session_id
+            WHERE {where}{session_filter}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?;
+            """,
+            params,
+        ).fetchall()
+    hits = [
+        {
+            "message_id": r["message_id"],
+            "session_id": r["session_id"],
+            "session_title": r["session_title"],
+            "role": r["role"],
+            "snippet": _plain_snippet(r["snippet"], q) if short else r["snippet"],
+            "score": 0.0 - float(r["score"]),
+            "created_at": r["created_at"],
+        }
+        for r in rows[:limit]
+    ]
+    return {"hits": hits, "next_offset": offset + limit if len(rows) > limit else None}
@@ -1,41 +1,204 @@
-from typing import Any, Dict, List
-from fastapi import APIRouter, HTTPException
+import sqlite3
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Query
+from .compression import encode_content
+from .config_cache import config_cache
+from .context import estimate_tokens
 from .db import db_session, message_row, session_row, utc_now_iso
-from .schemas import MessageCreate, MessageOut, SessionCreate, SessionOut, SessionUpdate, SessionWithMessages
+from .history_cache import history_cache
+from .schemas import CheckoutRequest, MessageCreate, MessageOut, SessionCreate, SessionOut, SessionUpdate, SessionWithMessages
+from .tracing import span
 
 router = APIRouter(prefix="/sessions", tags=["sessions"])
 
+# Walks parent pointers from a start node up to the root. Parents always have
+# smaller ids than their children, so ORDER BY id puts the branch in order.
+BRANCH_SQL = """
+WITH RECURSIVE branch(id, depth) AS (
+    SELECT ?, 0
+    UNION ALL
+    SELECT m.parent_id, branch.depth + 1 FROM chat_messages m JOIN branch ON m.id = branch.id
+    WHERE m.parent_id IS NOT NULL AND branch.depth < ?
+)
+SELECT m.* FROM branch JOIN chat_messages m ON m.id = branch.id ORDER BY m.id {order};
+"""
+MAX_DEPTH = 2**31
+
 def get_session(session_id: int) -> Dict[str, Any]:
-    with db_session() as db:
+    with db_session(readonly=True) as db:
         row = db.execute("SELECT * FROM chat_sessions WHERE id = ?;", (session_id,)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="session not found")
         return session_row(row)
 
-def touch_session(session_id: int) -> None:
-    with db_session() as db:
-        db.execute("UPDATE chat_sessions SET updated_at=? WHERE id=?;", (utc_now_iso(), session_id))
+def get_session_config_id(session_id: int) -> Optional[int]:
+    found, api_config_id = config_cache.session_config(session_id)
+    if found:
+        return api_config_id
+    epoch = config_cache.begin_load()
+    api_config_id = get_session(session_id)["api_config_id"]
+    config_cache.set_session_config(session_id, api_config_id, epoch)
+    return api_config_id
 
-def insert_message(session_id: int, role: str, content: str) -> Dict[str, Any]:
-    with db_session() as db:
-        now = utc_now_iso()
-        cur = db.execute(
-            "INSERT INTO chat_messages(session_id, role, content, created_at) VALUES(?,?,?,?);",
-            (session_id, role, content, now),
-        )
-        msg_id = cur.lastrowid
-        row = db.execute("SELECT * FROM chat_messages WHERE id = ?;", (msg_id,)).fetchone()
-    touch_session(session_id)
-    return message_row(row)
+def get_message(db: sqlite3.Connection, session_id: int, message_id: int) -> sqlite3.Row:
+    row = db.execute("SELECT * FROM chat_messages WHERE id = ? AND session_id = ?;", (message_id, session_id)).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="message not found")
+    return row
 
-def list_messages(session_id: int) -> List[Dict[str, Any]]:
-    with db_session() as db:
-        rows = db.execute(
-            "SELECT * FROM chat_messages WHERE session_id = ? ORDER BY id ASC;",
-            (session_id,),
-        ).fetchall()
+def insert_message(
+    session_id: int,
+    role: str,
+    content: str,
+    status: str = "complete",
+    api_config_id: Optional[int] = None,
+    variant_of: Optional[int] = None,
+    parent_id: Optional[int] = None,
+    checkout: bool = False,
+) -> Dict[str, Any]:
+    # Without parent_id the message is appended to the session's head. The
+    # trg_chat_messages_touch_session trigger bumps updated_at and advances the head
+    # when the message extends it; checkout=True makes it the head regardless.
+    # Cache appends happen under the writer lock so they are ordered like the commits.
+    try:
+        with db_session() as db:
+            row = db.execute(
+                """
+                INSERT INTO chat_messages(session_id, role, content, codec, token_count, status, api_config_id, variant_of, parent_id, created_at)
+                VALUES(?,?,?,?,?,?,?,?,COALESCE(?, (SELECT head_message_id FROM chat_sessions WHERE id = ?)),?) RETURNING *;
+                """,
+                (
+                    session_id, role, *encode_content(content), estimate_tokens(content), status, api_config_id, variant_of,
+                    parent_id, session_id, utc_now_iso(),
+                ),
+            ).fetchone()
+            if checkout:
+                db.execute("UPDATE chat_sessions SET head_message_id = ? WHERE id = ?;", (row["id"], session_id))
+            message = message_row(row, content)
+            history_cache.append(session_id, [message])
+    except Exception:
+        history_cache.invalidate(session_id)
+        raise
+    return message
+
+def _head(db: sqlite3.Connection, session_id: int) -> Optional[int]:
+    row = db.execute("SELECT head_message_id FROM chat_sessions WHERE id = ?;", (session_id,)).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="session not found")
+    return row["head_message_id"]
+
+def _load_messages(db: sqlite3.Connection, session_id: int, start: Optional[int] = None) -> List[Dict[str, Any]]:
+    # The active branch, or the branch ending at `start`.
+    with span("load_messages"):
+        if start is None:
+            start = _head(db, session_id)
+        rows = db.execute(BRANCH_SQL.format(order="ASC"), (start, MAX_DEPTH)).fetchall()
         return [message_row(r) for r in rows]
 
+def persist_turn(
+    session_id: int,
+    user_content: Optional[str],
+    system_prompt: Optional[str] = None,
+    parent_message_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    # Adds the user turn to the active branch, or branches off parent_message_id.
+    # Without user_content nothing is inserted: the head moves to the user message
+    # being answered (parent_message_id or the head, stepping up from an assistant
+    # reply) so the regenerated reply lands beside the old one.
+    now = utc_now_iso()
+    try:
+        with db_session() as db:
+            head = _head(db, session_id)
+            start = head
+            if parent_message_id is not None:
+                start = get_message(db, session_id, parent_message_id)["id"]
+            if user_content is None and start is not None:
+                node = get_message(db, session_id, start)
+                if node["role"] == "assistant" and node["parent_id"] is not None:
+                    start = node["parent_id"]
+            messages = history_cache.get(session_id) if start == head else None
+            cached = messages is not None
+            if messages is None:
+                # Switching branches leaves the cached one stale; drop it before reloading.
+                if start != head:
+                    history_cache.invalidate(session_id)
+                epoch = history_cache.begin_load()
+                messages = _load_messages(db, session_id, start)
+                uncounted = [m for m in messages if m["token_count"] is None]
+                if uncounted:
+                    for m in uncounted:
+                        m["token_count"] = estimate_tokens(m["content"])
+                    db.executemany(
+                        "UPDATE chat_messages SET token_count=? WHERE id=?;",
+                        [(m["token_count"], m["id"]) for m in uncounted],
+                    )
+            if user_content is None and (not messages or messages[-1]["role"] != "user"):
+                raise HTTPException(status_code=400, detail="nothing to regenerate: the branch does not end in a user message")
+            turn = [("system", system_prompt)] if system_prompt and user_content is not None else []
+            if user_content is not None:
+                turn.append(("user", user_content))
+            parent = start
+            inserted: List[Dict[str, Any]] = []
+            for role, content in turn:
+                row = db.execute(
+                    """
+                    INSERT INTO chat_messages(session_id, role, content, codec, token_count, parent_id, created_at)
+                    VALUES(?,?,?,?,?,?,?) RETURNING *;
+                    """,
+                    (session_id, role, *encode_content(content), estimate_tokens(content), parent, now),
+                ).fetchone()
+                inserted.append(message_row(row, content))
+                parent = row["id"]
+            if start != head:
+                db.execute("UPDATE chat_sessions SET head_message_id = ? WHERE id = ?;", (parent, session_id))
+            messages.extend(inserted)
+            if cached:
+                if inserted:
+                    history_cache.append(session_id, inserted)
+            else:
+                history_cache.fill(session_id, epoch, messages)
+    except HTTPException:
+        raise
+    except Exception:
+        history_cache.invalidate(session_id)
+        raise
+    return messages
+
+def list_messages(session_id: int) -> List[Dict[str, Any]]:
+    messages = history_cache.get(session_id)
+    if messages is not None:
+        return messages
+    epoch = history_cache.begin_load()
+    with db_session(readonly=True) as db:
+        messages = _load_messages(db, session_id)
+    history_cache.fill(session_id, epoch, messages)
+    return messages
+
+def list_message_page(session_id: int, before_id: Optional[int], limit: int) -> Tuple[List[Dict[str, Any]], bool]:
+    # Newest `limit` messages older than before_id, returned oldest first. Without
+    # before_id that is the active branch; with it, the ancestors of before_id, so a
+    # cursor keeps paging its own branch after a checkout. before_id must belong to
+    # the session (404). The cache only answers when before_id is on the cached
+    # active branch, where both rules agree. The walk stops after limit + 1 nodes,
+    # so a page costs O(limit).
+    cached = history_cache.get(session_id)
+    if cached is not None:
+        end = len(cached)
+        if before_id is not None:
+            end = bisect_left([m["id"] for m in cached], before_id)
+        if before_id is None or (end < len(cached) and cached[end]["id"] == before_id):
+            start = max(0, end - limit)
+            return cached[start:end], start > 0
+    with db_session(readonly=True) as db:
+        if before_id is None:
+            start = _head(db, session_id)
+        else:
+            start = get_message(db, session_id, before_id)["parent_id"]
+        rows = db.execute(BRANCH_SQL.format(order="DESC"), (start, limit)).fetchall()
+    has_more = len(rows) > limit
+    return [message_row(r) for r in reversed(rows[:limit])], has_more
+
 @router.post("", response_model=SessionOut)
 def create_session(payload: SessionCreate) -> Dict[str, Any]:
     now = utc_now_iso()
@@ -46,19 +209,43 @@ def create_session(payload: SessionCreate) -> Dict[str, Any]:
         )
         session_id = cur.lastrowid
         row = db.execute("SELECT * FROM chat_sessions WHERE id = ?;", (session_id,)).fetchone()
+        config_cache.set_session_config(session_id, payload.api_config_id)
         return session_row(row)
 
 @router.get("", response_model=List[SessionOut])
-def list_sessions() -> List[Dict[str, Any]]:
-    with db_session() as db:
-        rows = db.execute("SELECT * FROM chat_sessions ORDER BY updated_at DESC;").fetchall()
+def list_sessions(
+    limit: Optional[int] = Query(default=None, ge=1, le=500),
+    before_updated_at: Optional[str] = None,
+    before_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    # Keyset pagination over idx_chat_sessions_updated_at: pass the (updated_at, id)
+    # of the last session on the previous page to get the next one.
+    if (before_updated_at is None) != (before_id is None):
+        raise HTTPException(status_code=400, detail="before_updated_at and before_id must be given together")
+    sql = "SELECT * FROM chat_sessions"
+    params: List[Any] = []
+    if before_updated_at is not None and before_id is not None:
+        sql += " WHERE (updated_at, id) < (?, ?)"
+        params += [before_updated_at, before_id]
+    sql += " ORDER BY updated_at DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    with db_session(readonly=True) as db:
+        rows = db.execute(sql + ";", params).fetchall()
         return [session_row(r) for r in rows]
 
 @router.get("/{session_id}", response_model=SessionWithMessages)
-def read_session(session_id: int) -> Dict[str, Any]:
+def read_session(
+    session_id: int,
+    before_id: Optional[int] = None,
+    limit: Optional[int] = Query(default=None, ge=1, le=1000),
+) -> Dict[str, Any]:
     session = get_session(session_id)
-    messages = list_messages(session_id)
-    return {"session": session, "messages": messages}
+    if before_id is None and limit is None:
+        return {"session": session, "messages": list_messages(session_id), "has_more": False}
+    messages, has_more = list_message_page(session_id, before_id, limit or 100)
+    return {"session": session, "messages": messages, "has_more": has_more}
 
 @router.put("/{session_id}", response_model=SessionOut)
 def update_session(session_id: int, payload: SessionUpdate) -> Dict[str, Any]:
@@ -73,6 +260,7 @@ def update_session(session_id: int, payload: SessionUpdate) -> Dict[str, Any]:
             "UPDATE chat_sessions SET title=?, api_config_id=?, updated_at=? WHERE id=?;",
             (merged["title"], merged["api_config_id"], now, session_id),
         )
+        config_cache.set_session_config(session_id, merged["api_config_id"])
         row = db.execute("SELECT * FROM chat_sessions WHERE id = ?;", (session_id,)).fetchone()
         return session_row(row)
 
@@ -81,9 +269,35 @@ def delete_session(session_id: int) -> Dict[str, Any]:
     get_session(session_id)
     with db_session() as db:
         db.execute("DELETE FROM chat_sessions WHERE id = ?;", (session_id,))
+        history_cache.invalidate(session_id)
+        config_cache.forget_session(session_id)
     return {"deleted": session_id}
 
 @router.post("/{session_id}/messages", response_model=MessageOut)
 def add_message(session_id: int, payload: MessageCreate) -> Dict[str, Any]:
+    # With parent_message_id the message starts a new branch there and becomes the head.
     get_session(session_id)
-    return insert_message(session_id, payload.role, payload.content)
+    if payload.parent_message_id is not None:
+        with db_session(readonly=True) as db:
+            get_message(db, session_id, payload.parent_message_id)
+    return insert_message(
+        session_id, payload.role, payload.content, parent_id=payload.parent_message_id, checkout=payload.parent_message_id is not None
+    )
+
+@router.get("/{session_id}/messages/{message_id}/children", response_model=List[MessageOut])
+def list_children(session_id: int, message_id: int) -> List[Dict[str, Any]]:
+    # Alternatives at a fork: regenerated replies, edited prompts, fan-out answers.
+    with db_session(readonly=True) as db:
+        get_message(db, session_id, message_id)
+        rows = db.execute("SELECT * FROM chat_messages WHERE parent_id = ? ORDER BY id;", (message_id,)).fetchall()
+        return [message_row(r) for r in rows]
+
+@router.post("/{session_id}/checkout", response_model=SessionWithMessages)
+def checkout(session_id: int, payload: CheckoutRequest) -> Dict[str, Any]:
+    # Makes any message the head: O(1), no rows are copied. The next turn continues
+    # from it, which forks the conversation there.
+    with db_session() as db:
+        get_message(db, session_id, payload.message_id)
+        db.execute("UPDATE chat_sessions SET head_message_id = ? WHERE id = ?;", (payload.message_id, session_id))
+        history_cache.invalidate(session_id)
+    return {"session": get_session(session_id), "messages": list_messages(session_id), "has_more": False}
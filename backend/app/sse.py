@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+from typing import Any, AsyncIterator, List, Optional
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+SSE_FLUSH_WINDOW = float(os.environ.get("VIPER_SSE_FLUSH_MS") or 0) / 1000.0
+SSE_FLUSH_BYTES = 16 * 1024
+
+class SSEDeltaParser:
+    # Incremental parser for OpenAI-style chat completion streams. It is fed the
+    # same byte chunks that are relayed to the client and only collects the
+    # delta contents, so it never has to touch the bytes on the send path.
+    __slots__ = ("_tail", "pieces", "done", "events")
+
+    def __init__(self, keep_events: bool = False) -> None:
+        self._tail = b""
+        self.pieces: List[str] = []
+        self.done = False
+        # Raw `data:` payloads, collected only for callers that re-frame events.
+        self.events: Optional[List[bytes]] = [] if keep_events else None
+
+    def feed(self, chunk: bytes) -> None:
+        if self.done:
+            return
+        data = self._tail + chunk if self._tail else chunk
+        start = 0
+        while not self.done:
+            end = data.find(b"\n", start)
+            if end < 0:
+                break
+            self._line(data[start:end])
+            start = end + 1
+        self._tail = b"" if self.done else data[start:]
+
+    def close(self) -> None:
+        if self._tail:
+            tail, self._tail = self._tail, b""
+            self._line(tail)
+
+    def _line(self, line: bytes) -> None:
+        if not line.startswith(b"data:"):
+            return
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            self.done = True
+            return
+        if self.events is not None:
+            self.events.append(payload)
+        if b'"content"' not in payload:
+            return
+        try:
+            event: Any = _loads(payload)
+            piece = event["choices"][0]["delta"]["content"]
+        except Exception:
+            return
+        if isinstance(piece, str) and piece:
+            self.pieces.append(piece)
+
+    @property
+    def content(self) -> str:
+        return "".join(self.pieces)
+
+def sse_content(body: bytes) -> str:
+    parser = SSEDeltaParser()
+    parser.feed(body)
+    parser.close()
+    return parser.content
+
+async def relay(source: AsyncIterator[bytes], flush_window: float = SSE_FLUSH_WINDOW, flush_bytes: int = SSE_FLUSH_BYTES) -> AsyncIterator[bytes]:
+    # Forwards upstream chunks unchanged. With a flush window, chunks that arrive
+    # within `flush_window` seconds of the first buffered one are sent together.
+    if flush_window <= 0:
+        async for chunk in source:
+            yield chunk
+        return
+    loop = asyncio.get_running_loop()
+    it = source.__aiter__()
+    buffer = bytearray()
+    deadline = 0.0
+    pending = asyncio.ensure_future(it.__anext__())
+    try:
+        while True:
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield bytes(buffer)
+                buffer.clear()
+                continue
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                break
+            if not buffer:
+                deadline = loop.time() + flush_window
+            buffer += chunk
+            if len(buffer) >= flush_bytes or loop.time() >= deadline:
+                yield bytes(buffer)
+                buffer.clear()
+            pending = asyncio.ensure_future(it.__anext__())
+        if buffer:
+            yield bytes(buffer)
+    finally:
+        if not pending.done():
+            pending.cancel()
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+import anyio
+
+STREAM_BUFFER_EVENTS = int(os.environ.get("VIPER_STREAM_BUFFER_EVENTS") or 4096)
+STREAM_RESUME_GRACE = float(os.environ.get("VIPER_STREAM_RESUME_GRACE") or 10)
+STREAM_RETAIN = float(os.environ.get("VIPER_STREAM_RETAIN") or 60)
+
+logger = logging.getLogger(__name__)
+
+def error_event(message: str, **fields: object) -> bytes:
+    # Terminal event for clients; OpenAI-style consumers skip it because it has no choices.
+    return b"event: error\ndata: %s\n\n" % json.dumps({"error": message, **fields}, ensure_ascii=False).encode("utf-8")
+
+def _event_boundary(data: bytes) -> int:
+    lf = data.rfind(b"\n\n")
+    crlf = data.rfind(b"\r\n\r\n")
+    return max(lf + 2 if lf >= 0 else 0, crlf + 4 if crlf >= 0 else 0)
+
+class Generation:
+    # One upstream generation. The producer task runs independently of any HTTP
+    # response and appends complete SSE events to a bounded ring buffer; responses
+    # subscribe from a sequence number, so a reconnecting client (Last-Event-ID)
+    # or a second tab replays what it missed and then follows the live tail.
+    def __init__(self, session_id: int) -> None:
+        self.id = secrets.token_hex(8)
+        self.session_id = session_id
+        # Sessions waiting on this generation: the leader plus coalesced followers.
+        # A session that cancels while others remain is detached instead of stopping it.
+        self.sessions: Set[int] = {session_id}
+        self.on_detach: List[Callable[[int], None]] = []
+        self.status = "running"
+        self.task: Optional["asyncio.Task[None]"] = None
+        # Cancellation goes through an anyio scope rather than task.cancel(), so the
+        # producer's shielded cleanup (slot release, persistence) always runs to the end.
+        self._scope: Optional[anyio.CancelScope] = None
+        self._cancelled = False
+        self.subscribers = 0
+        self._events: Deque[Tuple[int, bytes]] = deque(maxlen=STREAM_BUFFER_EVENTS)
+        self._next_seq = 0
+        self._tail = b""
+        self._changed = asyncio.Event()
+        self._grace: Optional[asyncio.TimerHandle] = None
+
+    def publish(self, chunk: bytes) -> None:
+        data = self._tail + chunk if self._tail else chunk
+        cut = _event_boundary(data)
+        self._tail = data[cut:]
+        if cut:
+            self._append(data[:cut])
+
+    def _append(self, data: bytes) -> None:
+        # The trailing id-only block sets the client's last event id once the whole chunk arrived.
+        self._events.append((self._next_seq, data + b"id: %d\n\n" % self._next_seq))
+        self._next_seq += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def finish(self, status: str, error: Optional[str] = None) -> None:
+        if self.status != "running":
+            return
+        if self._tail:
+            tail, self._tail = self._tail, b""
+            self._append(tail if tail.endswith(b"\n") else tail + b"\n\n")
+        if error is not None:
+            self._append(error_event(error, status=status))
+        self.status = status
+        self._changed.set()
+
+    def cancel(self) -> bool:
+        # One-shot: returns False once cancelled or finished.
+        if self._cancelled or self.status != "running" or (self.task is not None and self.task.done()):
+            return False
+        self._cancelled = True
+        if self._scope is not None:
+            self._scope.cancel()
+        return True
+
+    def detach(self, session_id: int) -> None:
+        self.sessions.discard(session_id)
+        for callback in self.on_detach:
+            callback(session_id)
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def replayable(self, last_event_id: Optional[int]) -> bool:
+        seq = 0 if last_event_id is None else last_event_id + 1
+        return not self._events or self._events[0][0] <= seq
+
+    async def subscribe(self, last_event_id: Optional[int] = None, session_id: Optional[int] = None) -> AsyncIterator[bytes]:
+        # With session_id, the response ends once that session is detached.
+        seq = 0 if last_event_id is None else last_event_id + 1
+        self.subscribers += 1
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+        try:
+            while True:
+                changed = self._changed
+                if session_id is not None and session_id not in self.sessions:
+                    return
+                if self._events and self._events[-1][0] >= seq:
+                    start = seq - self._events[0][0]
+                    if start < 0:
+                        # Fell behind the ring buffer; say so instead of ending mid-stream.
+                        yield error_event("subscriber fell behind the stream buffer", status="lagged", last_event_id=seq - 1)
+                        return
+                    for i in range(start, len(self._events)):
+                        event_seq, frame = self._events[i]
+                        seq = event_seq + 1
+                        yield frame
+                    continue
+                if self.status != "running":
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and self.status == "running":
+                # Keep generating for a short while so a dropped client can resume.
+                if STREAM_RESUME_GRACE > 0:
+                    self._grace = asyncio.get_running_loop().call_later(STREAM_RESUME_GRACE, self._abandon)
+                else:
+                    self.cancel()
+
+    def _abandon(self) -> None:
+        self._grace = None
+        if self.subscribers == 0:
+            self.cancel()
+
+_generations: Dict[int, Set[Generation]] = {}
+_by_id: Dict[str, Generation] = {}
+
+def start_generation(session_id: int, produce: Callable[[Generation], Awaitable[None]]) -> Generation:
+    gen = Generation(session_id)
+    _generations.setdefault(session_id, set()).add(gen)
+    _by_id[gen.id] = gen
+    gen.task = asyncio.create_task(_run(gen, produce))
+    return gen
+
+async def _run(gen: Generation, produce: Callable[[Generation], Awaitable[None]]) -> None:
+    try:
+        with anyio.CancelScope() as scope:
+            gen._scope = scope
+            if gen._cancelled:
+                scope.cancel()
+            await produce(gen)
+    except Exception as e:
+        logger.exception("generation %s failed", gen.id)
+        gen.finish("error", str(e) or type(e).__name__)
+    finally:
+        gen.finish("truncated")
+        for session_id in gen.sessions:
+            _unregister(gen, session_id)
+        # Finished generations stay replayable for late reconnects.
+        asyncio.get_running_loop().call_later(STREAM_RETAIN, _by_id.pop, gen.id, None)
+
+def _unregister(gen: Generation, session_id: int) -> None:
+    active = _generations.get(session_id)
+    if active is not None:
+        active.discard(gen)
+        if not active:
+            del _generations[session_id]
+
+def attach_generation(gen: Generation, session_id: int) -> None:
+    gen.sessions.add(session_id)
+    _generations.setdefault(session_id, set()).add(gen)
+
+def get_generation(generation_id: str) -> Optional[Generation]:
+    return _by_id.get(generation_id)
+
+def cancel_generations(session_id: int) -> int:
+    # The upstream is only cancelled once no other session is attached.
+    cancelled = 0
+    for gen in list(_generations.get(session_id, ())):
+        if gen.status == "running" and len(gen.sessions) > 1:
+            gen.detach(session_id)
+            _unregister(gen, session_id)
+            cancelled += 1
+        elif gen.cancel():
+            cancelled += 1
+    return cancelled
+
+def _active() -> Set[Generation]:
+    return {gen for active in _generations.values() for gen in active}
+
+def active_generation_count() -> int:
+    return len(_active())
+
+def subscriber_count() -> int:
+    return sum(gen.subscribers for gen in _active())
@@ -0,0 +1,124 @@
+import os
+import re
+import secrets
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+from .profiler import profiler
+
+TRACING_ENABLED = (os.environ.get("VIPER_TRACING") or "1") != "0"
+TRACE_BUFFER = int(os.environ.get("VIPER_TRACE_BUFFER") or 200)
+TRACE_HEADER = "X-Trace-Id"
+
+_NON_TOKEN = re.compile(r"[^A-Za-z0-9_.-]+")
+
+class Trace:
+    # Spans of one HTTP request. Worker threads (run_in_threadpool) and producer
+    # tasks inherit the context, so their spans land in the same trace.
+    __slots__ = ("id", "method", "path", "started_at", "started", "duration", "status", "spans")
+
+    def __init__(self, method: str, path: str) -> None:
+        self.id = secrets.token_hex(8)
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status = 0
+        self.spans: List[Dict[str, Any]] = []
+
+    def server_timing(self) -> str:
+        totals: Dict[str, float] = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["duration_ms"]
+        parts = [f"{_NON_TOKEN.sub('-', name)};dur={ms:.2f}" for name, ms in totals.items()]
+        parts.append(f"app;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(parts)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": None if self.duration is None else round(self.duration * 1000, 3),
+            "spans": list(self.spans),
+        }
+
+_current: ContextVar[Optional[Trace]] = ContextVar("viper_trace", default=None)
+# Nesting depth lives in the context rather than on the trace: tasks under
+# asyncio.gather and threadpool calls each get a copy, so concurrent spans nest
+# under the span that started them instead of under each other.
+_depth: ContextVar[int] = ContextVar("viper_span_depth", default=0)
+_traces: Deque[Trace] = deque(maxlen=TRACE_BUFFER)
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    depth = _depth.get()
+    _depth.set(depth + 1)
+    try:
+        yield
+    finally:
+        _depth.set(depth)
+        trace.spans.append(
+            {
+                "name": name,
+                "start_ms": round((started - trace.started) * 1000, 3),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+                "depth": depth,
+            }
+        )
+
+def recent_traces(limit: int) -> List[Dict[str, Any]]:
+    return [t.as_dict() for t in list(_traces)[-limit:]][::-1]
+
+def find_trace(trace_id: str) -> Optional[Dict[str, Any]]:
+    for trace in _traces:
+        if trace.id == trace_id:
+            return trace.as_dict()
+    return None
+
+class TracingMiddleware:
+    # Starts a trace per HTTP request, adds Server-Timing (spans finished before the
+    # response headers) and X-Trace-Id, and keeps finished traces in a ring buffer.
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        trace = Trace(scope["method"], scope["path"])
+        token = _current.set(trace)
+        depth_token = _depth.set(0)
+        profiling = profiler.request_started()
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                headers = list(message.get("headers") or [])
+                headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                headers.append((TRACE_HEADER.lower().encode("latin-1"), trace.id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            trace.duration = time.perf_counter() - trace.started
+            _depth.reset(depth_token)
+            _current.reset(token)
+            _traces.append(trace)
+            if profiling:
+                profiler.request_finished()
@@ -0,0 +1,324 @@
+import json
+import sqlite3
+import zlib
+from typing import Any, AsyncIterator, Dict, Generator, List, Optional, Set, Tuple
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from fastapi.responses import StreamingResponse
+from .compression import encode_content
+from .context import estimate_tokens
+from .db import db_session, message_row, session_row
+
+router = APIRouter(prefix="/sessions", tags=["sessions"])
+
+EXPORT_CHUNK = 1000
+IMPORT_BATCH = 5000
+ROLES = ("system", "user", "assistant")
+
+def _session_filter(session_ids: Optional[str], updated_after: Optional[str]) -> Tuple[str, List[Any]]:
+    clauses: List[str] = []
+    params: List[Any] = []
+    if session_ids:
+        try:
+            ids = [int(x) for x in session_ids.split(",") if x.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="session_ids must be comma separated integers")
+        clauses.append(f"id IN ({','.join('?' * len(ids))})")
+        params += ids
+    if updated_after:
+        clauses.append("updated_at > ?")
+        params.append(updated_after)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def _export_lines(where: str, params: List[Any]) -> Generator[bytes, None, None]:
+    # One read transaction gives a consistent snapshot; WAL keeps writers unblocked.
+    # Sessions and their messages are read by two cursors in the same order and
+    # merged, so memory stays at one fetchmany chunk per cursor.
+    with db_session(readonly=True) as db:
+        db.execute("BEGIN;")
+        sessions = db.execute(f"SELECT * FROM chat_sessions{where} ORDER BY id;", params)
+        messages = db.execute(
+            f"""
+            SELECT * FROM chat_messages
+            WHERE session_id IN (SELECT id FROM chat_sessions{where})
+            ORDER BY session_id, id;
+            """,
+            params,
+        )
+        pending: List[sqlite3.Row] = []
+        out: List[str] = []
+
+        def next_message() -> Optional[sqlite3.Row]:
+            if not pending:
+                pending.extend(reversed(messages.fetchmany(EXPORT_CHUNK)))
+            return pending.pop() if pending else None
+
+        message = next_message()
+        while True:
+            rows = sessions.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            for row in rows:
+                out.append(json.dumps({"type": "session", **session_row(row)}, ensure_ascii=False))
+                while message is not None and message["session_id"] <= row["id"]:
+                    if message["session_id"] == row["id"]:
+                        out.append(json.dumps({"type": "message", **message_row(message)}, ensure_ascii=False))
+                    message = next_message()
+                    if len(out) >= EXPORT_CHUNK:
+                        yield ("\n".join(out) + "\n").encode("utf-8")
+                        out.clear()
+            if out:
+                yield ("\n".join(out) + "\n").encode("utf-8")
+                out.clear()
+
+def _gzip(chunks: Generator[bytes, None, None]) -> Generator[bytes, None, None]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+async def _closing(chunks: Generator[bytes, None, None], source: Generator[bytes, None, None]) -> AsyncIterator[bytes]:
+    # Starlette drops a sync iterator on client disconnect without closing it, which
+    # would hold the export's reader connection and pool slot until garbage collection.
+    # Closing runs the generators' cleanup, releasing the connection right away.
+    try:
+        async for chunk in iterate_in_threadpool(chunks):
+            yield chunk
+    finally:
+        chunks.close()
+        source.close()
+
+@router.get("/export")
+def export_sessions(
+    session_ids: Optional[str] = None,
+    updated_after: Optional[str] = None,
+    format: str = Query(default="ndjson", pattern="^(ndjson|gzip)$"),
+):
+    where, params = _session_filter(session_ids, updated_after)
+    body = _export_lines(where, params)
+    if format == "gzip":
+        headers = {"Content-Disposition": 'attachment; filename="viper-sessions.ndjson.gz"'}
+        return StreamingResponse(_closing(_gzip(body), body), media_type="application/gzip", headers=headers)
+    headers = {"Content-Disposition": 'attachment; filename="viper-sessions.ndjson"'}
+    return StreamingResponse(_closing(body, body), media_type="application/x-ndjson", headers=headers)
+
+class _Importer:
+    # Buffered rows carry local ids (1, 2, ...). Each flush allocates real ids above
+    # the table's current maximum inside the writer transaction, so a whole batch is
+    # written with executemany and no RETURNING round trips. Message ids are only
+    # remembered for the current session (parent_id and variant_of never cross
+    # sessions), which keeps memory flat on large imports.
+    def __init__(self, config_ids: Set[int]) -> None:
+        self.config_ids = config_ids
+        self.session_map: Dict[Any, int] = {}
+        self.message_map: Dict[Any, int] = {}
+        self.session_ids: Dict[int, int] = {}
+        self.message_ids: Dict[int, int] = {}
+        self.ids_session: Optional[int] = None
+        self.current_session: Optional[int] = None
+        self.closed_sessions: Set[int] = set()
+        self.tail: Optional[int] = None
+        self.variant_groups: Set[int] = set()
+        self.head_ids: Dict[int, Any] = {}
+        self.heads: List[Tuple[int, int]] = []
+        self.head_pins: List[Tuple[int, int]] = []
+        self.sessions: List[Tuple[Any, ...]] = []
+        self.messages: List[Tuple[Any, ...]] = []
+        self.updated_at: Dict[int, str] = {}
+        self.session_count = 0
+        self.message_count = 0
+
+    def pending(self) -> int:
+        return len(self.sessions) + len(self.messages)
+
+    def add(self, number: int, item: Any) -> None:
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"line {number}: expected an object")
+        kind = item.get("type")
+        if kind == "session":
+            self._add_session(number, item)
+        elif kind == "message":
+            self._add_message(number, item)
+        else:
+            raise HTTPException(status_code=400, detail=f"line {number}: unknown type {kind!r}")
+
+    def _add_session(self, number: int, item: Dict[str, Any]) -> None:
+        if not isinstance(item.get("title"), str) or not isinstance(item.get("created_at"), str):
+            raise HTTPException(status_code=400, detail=f"line {number}: session needs title and created_at")
+        self.session_count += 1
+        local = self.session_count
+        if item.get("id") is not None:
+            self.session_map[item["id"]] = local
+        config_id = item.get("api_config_id")
+        updated_at = item.get("updated_at") or item["created_at"]
+        self.sessions.append((local, item["title"], config_id if config_id in self.config_ids else None, item["created_at"], updated_at))
+        self.updated_at[local] = updated_at
+        if item.get("head_message_id") is not None:
+            self.head_ids[local] = item["head_message_id"]
+
+    def _add_message(self, number: int, item: Dict[str, Any]) -> None:
+        session = self.session_map.get(item.get("session_id"))
+        if session is None:
+            raise HTTPException(status_code=400, detail=f"line {number}: message before its session")
+        if item.get("role") not in ROLES or not isinstance(item.get("content"), str) or not isinstance(item.get("created_at"), str):
+            raise HTTPException(status_code=400, detail=f"line {number}: message needs role, content and created_at")
+        if session != self.current_session:
+            # Parents are resolved as lines arrive, so a session's messages must be
+            # contiguous and each parent must come before its children (as exported).
+            if session in self.closed_sessions:
+                raise HTTPException(status_code=400, detail=f"line {number}: messages of a session must be contiguous")
+            if self.current_session is not None:
+                self.closed_sessions.add(self.current_session)
+            self.current_session = session
+            self.message_map.clear()
+            self.tail = None
+            self.variant_groups.clear()
+        self.message_count += 1
+        local = self.message_count
+        for field in ("variant_of", "parent_id"):
+            if item.get(field) is not None and item[field] not in self.message_map:
+                raise HTTPException(status_code=400, detail=f"line {number}: {field} {item[field]!r} is not an earlier message of this session")
+        variant_of = self.message_map.get(item.get("variant_of"))
+        if "parent_id" in item:
+            parent = self.message_map.get(item["parent_id"])
+        else:
+            # Exports from before message trees: rebuild the chain the way the schema
+            # migration does, with fan-out answers as siblings under their prompt.
+            parent = self.tail if variant_of is None else variant_of
+        if variant_of is None or variant_of not in self.variant_groups:
+            self.tail = local
+            if variant_of is not None:
+                self.variant_groups.add(variant_of)
+        if item.get("id") is not None:
+            self.message_map[item["id"]] = local
+            if self.head_ids.get(session) == item["id"]:
+                self.heads.append((session, local))
+                del self.head_ids[session]
+        config_id = item.get("api_config_id")
+        token_count = item.get("token_count")
+        self.messages.append(
+            (
+                local,
+                session,
+                item["role"],
+                *encode_content(item["content"]),
+                token_count if isinstance(token_count, int) else estimate_tokens(item["content"]),
+                item.get("status") or "complete",
+                config_id if config_id in self.config_ids else None,
+                variant_of,
+                parent,
+                item["created_at"],
+            )
+        )
+
+def _next_id(db: sqlite3.Connection, table: str) -> int:
+    row = db.execute(
+        f"SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0), COALESCE((SELECT MAX(id) FROM {table}), 0)) AS m;",
+        (table,),
+    ).fetchone()
+    return row["m"] + 1
+
+def _existing_config_ids() -> Set[int]:
+    with db_session(readonly=True) as db:
+        return {r["id"] for r in db.execute("SELECT id FROM api_configs;").fetchall()}
+
+def _flush(importer: _Importer) -> None:
+    with db_session() as db:
+        if importer.sessions:
+            offset = _next_id(db, "chat_sessions") - importer.sessions[0][0]
+            importer.session_ids.update((s[0], s[0] + offset) for s in importer.sessions)
+            db.executemany(
+                "INSERT INTO chat_sessions(id, title, api_config_id, created_at, updated_at) VALUES(?,?,?,?,?);",
+                ((s[0] + offset,) + s[1:] for s in importer.sessions),
+            )
+        if importer.messages:
+            first = importer.messages[0][0]
+            offset = _next_id(db, "chat_messages") - first
+            # References below this batch point into the session that was still open
+            # at the last flush, whose ids are kept in message_ids.
+            ids = importer.message_ids
+            session_ids = importer.session_ids
+
+            def remap(local: Optional[int]) -> Optional[int]:
+                return local + offset if local is not None and local >= first else ids.get(local)
+
+            rows = [
+                (m[0] + offset, session_ids[m[1]]) + m[2:8] + (remap(m[8]), remap(m[9]), m[10])
+                for m in importer.messages
+            ]
+            current = {m[0]: m[0] + offset for m in importer.messages if m[1] == importer.current_session}
+            if importer.ids_session != importer.current_session:
+                ids.clear()
+                importer.ids_session = importer.current_session
+            ids.update(current)
+            db.executemany(
+                """
+                INSERT INTO chat_messages(id, session_id, role, content, codec, token_count, status, api_config_id, variant_of, parent_id, created_at)
+                VALUES(?,?,?,?,?,?,?,?,?,?,?);
+                """,
+                rows,
+            )
+            # The touch trigger moved updated_at to each message's created_at; restore the exported value.
+            db.executemany(
+                "UPDATE chat_sessions SET updated_at = ? WHERE id = ?;",
+                ((importer.updated_at[s], session_ids[s]) for s in {m[1] for m in importer.messages}),
+            )
+            importer.head_pins.extend((m + offset, session_ids[s]) for s, m in importer.heads)
+            importer.heads.clear()
+    importer.sessions.clear()
+    importer.messages.clear()
+
+def _pin_heads(importer: _Importer) -> None:
+    # The touch trigger moves each head along the imported messages, including children
+    # of the exported head that arrive in a later batch; pin the exported heads once
+    # every message is in.
+    with db_session() as db:
+        db.executemany("UPDATE chat_sessions SET head_message_id = ? WHERE id = ?;", importer.head_pins)
+    importer.head_pins.clear()
+
+@router.post("/import")
+async def import_sessions(request: Request) -> Dict[str, Any]:
+    importer = _Importer(await run_in_threadpool(_existing_config_ids))
+    gzip = request.headers.get("content-encoding", "").lower() == "gzip"
+    decompressor: Optional[Any] = None
+    tail = b""
+    number = 0
+    first = True
+    # Batches commit as they fill; on a malformed line the earlier batches stay imported.
+    try:
+        async for chunk in request.stream():
+            if first and chunk:
+                first = False
+                if gzip or chunk[:2] == b"\x1f\x8b":
+                    decompressor = zlib.decompressobj(47)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                number += 1
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    raise HTTPException(status_code=400, detail=f"line {number}: invalid JSON")
+                importer.add(number, item)
+                if importer.pending() >= IMPORT_BATCH:
+                    await run_in_threadpool(_flush, importer)
+        if decompressor is not None:
+            tail += decompressor.flush()
+        if tail.strip():
+            number += 1
+            try:
+                importer.add(number, json.loads(tail))
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"line {number}: invalid JSON")
+        if importer.pending():
+            await run_in_threadpool(_flush, importer)
+    finally:
+        if importer.head_pins:
+            await run_in_threadpool(_pin_heads, importer)
+    return {"sessions": importer.session_count, "messages": importer.message_count}
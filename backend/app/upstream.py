@@ -0,0 +1,108 @@
+import asyncio
+import importlib.util
+import json
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    import httpx
+
+# httpx (and the click CLI it pulls in) is imported on the first upstream call
+# rather than at startup; nothing before that needs it.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+_clients: Dict[int, Tuple[str, "httpx.AsyncClient"]] = {}
+# Clients replaced after a config change stay open until their last borrowed
+# request finishes, then close; _borrowed counts requests in flight per client.
+_retired: Set["httpx.AsyncClient"] = set()
+_borrowed: Dict["httpx.AsyncClient", int] = {}
+_closing: Set["asyncio.Task[None]"] = set()
+
+def chat_url(base_url: str, chat_completions_path: Optional[str]) -> str:
+    chat_path = chat_completions_path or "/v1/chat/completions"
+    chat_path = chat_path if chat_path.startswith("/") else f"/{chat_path}"
+    return base_url.rstrip("/") + chat_path
+
+def chat_headers(api_key: Optional[str], extra_headers: Dict[str, Any]) -> Dict[str, str]:
+    headers: Dict[str, str] = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    for k, v in (extra_headers or {}).items():
+        if isinstance(v, str) and v is not None:
+            headers[k] = str(v)
+    return headers
+
+def chat_payload(model: str, messages: List[Dict[str, str]], temperature: float, stream: bool) -> bytes:
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "stream": stream,
+    }
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+def get_client(cfg: Dict[str, Any]) -> "httpx.AsyncClient":
+    # One keep-alive pool per api_config; a changed base_url gets a fresh pool so
+    # connections to the old host are not reused.
+    entry = _clients.get(cfg["id"])
+    if entry is not None and entry[0] == cfg["base_url"]:
+        return entry[1]
+    if entry is not None:
+        _retire(entry[1])
+    import httpx
+
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(120.0, connect=15.0),
+        limits=httpx.Limits(max_connections=512, max_keepalive_connections=64, keepalive_expiry=90.0),
+        http2=HTTP2_AVAILABLE,
+    )
+    _clients[cfg["id"]] = (cfg["base_url"], client)
+    return client
+
+def _retire(client: "httpx.AsyncClient") -> None:
+    if _borrowed.get(client):
+        _retired.add(client)
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _retired.add(client)
+        return
+    task = loop.create_task(client.aclose())
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+def acquire_client(cfg: Dict[str, Any]) -> "httpx.AsyncClient":
+    # Pair every acquire with release_client once the response has been closed.
+    client = get_client(cfg)
+    _borrowed[client] = _borrowed.get(client, 0) + 1
+    return client
+
+def release_client(client: "httpx.AsyncClient") -> None:
+    left = _borrowed.get(client, 0) - 1
+    if left > 0:
+        _borrowed[client] = left
+        return
+    _borrowed.pop(client, None)
+    if client in _retired:
+        _retired.discard(client)
+        _retire(client)
+
+def build_chat_request(
+    cfg: Dict[str, Any], messages: List[Dict[str, str]], temperature: float, stream: bool, client: Optional["httpx.AsyncClient"] = None
+) -> "httpx.Request":
+    client = client or get_client(cfg)
+    return client.build_request(
+        "POST",
+        cfg.get("url") or chat_url(cfg["base_url"], cfg.get("chat_completions_path")),
+        content=chat_payload(cfg["model"], messages, temperature, stream),
+        headers=cfg.get("headers") or chat_headers(cfg["api_key"], cfg["extra_headers"]),
+    )
+
+async def close_clients() -> None:
+    clients = [c for _, c in _clients.values()] + list(_retired)
+    _clients.clear()
+    _retired.clear()
+    _borrowed.clear()
+    for client in clients:
+        await client.aclose()
+    await asyncio.gather(*_closing, return_exceptions=True)
@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Dict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+
+# OpenAI-compatible /v1/chat/completions with a fixed latency before the first
+# token, a steady token rate and a configurable number of tokens per SSE chunk.
+
+def create_app(latency: float, tokens_per_second: float, chunk_tokens: int, output_tokens: int) -> FastAPI:
+    app = FastAPI()
+    stats = {"requests": 0, "streams": 0}
+    token_delay = 1.0 / tokens_per_second if tokens_per_second > 0 else 0.0
+
+    def chunk_event(text: str) -> bytes:
+        event = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": text}}]}
+        return b"data: " + json.dumps(event).encode("utf-8") + b"\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body: Dict[str, Any] = json.loads(await request.body())
+        stats["requests"] += 1
+        await asyncio.sleep(latency)
+        words = [f"tok{i} " for i in range(output_tokens)]
+        if not body.get("stream"):
+            await asyncio.sleep(token_delay * output_tokens)
+            raw = {
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)}, "finish_reason": "stop"}],
+            }
+            return Response(json.dumps(raw), media_type="application/json")
+        stats["streams"] += 1
+
+        async def events():
+            # Sleep until each chunk's due time so the rate holds even when the loop is busy.
+            started = time.perf_counter()
+            for i in range(0, len(words), chunk_tokens):
+                due = started + token_delay * (i + chunk_tokens)
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield chunk_event("".join(words[i:i + chunk_tokens]))
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    def read_stats():
+        return stats
+
+    return app
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible upstream for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="tokens per SSE event")
+    parser.add_argument("--output-tokens", type=int, default=64)
+    args = parser.parse_args()
+    app = create_app(args.latency, args.tokens_per_second, max(1, args.chunk_tokens), args.output_tokens)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Starts the mock upstream and the backend as subprocesses, drives the HTTP API at
+# a fixed concurrency and writes a JSON baseline. Run from the repository root:
+#   python -m backend.bench.run --save before
+#   python -m backend.bench.run --compare before
+
+ROOT = Path(__file__).resolve().parents[2]
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+SCENARIOS = ("create_session", "list_sessions", "read_session", "chat", "stream")
+LIST_PAGE = 50
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _wait_http(url: str, proc: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"process exited with {proc.returncode} before {url} came up")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"timed out waiting for {url}")
+
+class ProcessProbe:
+    # CPU seconds and RSS of the backend process, via psutil when installed and /proc otherwise.
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self._proc = psutil.Process(pid) if psutil is not None else None
+
+    def cpu_seconds(self) -> Optional[float]:
+        if self._proc is not None:
+            t = self._proc.cpu_times()
+            return t.user + t.system
+        try:
+            fields = Path(f"/proc/{self.pid}/stat").read_text().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / CLK_TCK
+        except OSError:
+            return None
+
+    def rss_bytes(self) -> Optional[int]:
+        if self._proc is not None:
+            return self._proc.memory_info().rss
+        try:
+            for line in Path(f"/proc/{self.pid}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def _ms(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value * 1000, 3)
+
+async def _seed_sessions(client: httpx.AsyncClient, api_config_id: int, count: int, history: int) -> List[int]:
+    ids: List[int] = []
+    for i in range(count):
+        resp = await client.post("/sessions", json={"title": f"bench {i}", "api_config_id": api_config_id})
+        resp.raise_for_status()
+        session_id = resp.json()["id"]
+        for j in range(history):
+            role = "user" if j % 2 == 0 else "assistant"
+            content = f"history message {j} " + "lorem ipsum dolor sit amet " * 8
+            (await client.post(f"/sessions/{session_id}/messages", json={"role": role, "content": content})).raise_for_status()
+        ids.append(session_id)
+    return ids
+
+async def _one(client: httpx.AsyncClient, scenario: str, i: int, sessions: List[int]) -> Tuple[float, Optional[float]]:
+    session_id = sessions[i % len(sessions)]
+    started = time.perf_counter()
+    ttft: Optional[float] = None
+    if scenario == "create_session":
+        resp = await client.post("/sessions", json={"title": f"created {i}"})
+        resp.raise_for_status()
+    elif scenario == "list_sessions":
+        # First page of the session list, then the next one by its keyset cursor.
+        resp = await client.get("/sessions", params={"limit": LIST_PAGE})
+        resp.raise_for_status()
+        page = resp.json()
+        if page:
+            cursor = {"limit": LIST_PAGE, "before_updated_at": page[-1]["updated_at"], "before_id": page[-1]["id"]}
+            (await client.get("/sessions", params=cursor)).raise_for_status()
+    elif scenario == "read_session":
+        resp = await client.get(f"/sessions/{session_id}")
+        resp.raise_for_status()
+    elif scenario == "chat":
+        resp = await client.post("/chat/chat", json={"session_id": session_id, "user_content": f"bench prompt {i}"})
+        resp.raise_for_status()
+    else:
+        async with client.stream("POST", "/chat/stream", json={"session_id": session_id, "user_content": f"bench prompt {i}"}) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes():
+                if ttft is None and b"data:" in chunk:
+                    ttft = time.perf_counter() - started
+    return time.perf_counter() - started, ttft
+
+async def _run_scenario(
+    client: httpx.AsyncClient, scenario: str, requests: int, concurrency: int, sessions: List[int], probe: ProcessProbe
+) -> Dict[str, Any]:
+    latencies: List[float] = []
+    ttfts: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+    rss_peak = probe.rss_bytes() or 0
+    running = True
+
+    async def sample_rss() -> None:
+        nonlocal rss_peak
+        while running:
+            rss_peak = max(rss_peak, probe.rss_bytes() or 0)
+            await asyncio.sleep(0.2)
+
+    async def worker() -> None:
+        nonlocal errors
+        for i in counter:
+            try:
+                latency, ttft = await _one(client, scenario, i, sessions)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(latency)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    sampler = asyncio.create_task(sample_rss())
+    cpu_before = probe.cpu_seconds()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    cpu_after = probe.cpu_seconds()
+    running = False
+    await sampler
+    cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+    return {
+        "requests": requests,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": _ms(_percentile(latencies, 0.50)),
+        "p99_ms": _ms(_percentile(latencies, 0.99)),
+        "ttft_p50_ms": _ms(_percentile(ttfts, 0.50)),
+        "ttft_p99_ms": _ms(_percentile(ttfts, 0.99)),
+        "backend_cpu_s": None if cpu is None else round(cpu, 3),
+        "backend_cpu_pct": None if cpu is None or not elapsed else round(cpu / elapsed * 100, 1),
+        "backend_rss_peak_mb": round(rss_peak / (1024 * 1024), 1) if rss_peak else None,
+    }
+
+async def _drive(args: argparse.Namespace, backend_url: str, mock_url: str, probe: ProcessProbe) -> Dict[str, Any]:
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=backend_url, timeout=120.0, limits=limits) as client:
+        resp = await client.post("/api-configs", json={"name": "bench", "base_url": mock_url, "model": "bench-model"})
+        resp.raise_for_status()
+        api_config_id = resp.json()["id"]
+        results: Dict[str, Any] = {}
+        for history in args.history:
+            sessions = await _seed_sessions(client, api_config_id, args.sessions, history)
+            for scenario in args.scenarios:
+                # One untimed pass per scenario so connection setup and cold caches do not skew the numbers.
+                await _run_scenario(client, scenario, min(args.warmup, args.requests), args.concurrency, sessions, probe)
+                result = await _run_scenario(client, scenario, args.requests, args.concurrency, sessions, probe)
+                results[f"{scenario}/history={history}"] = result
+                print(f"{scenario:>15} history={history:<4} " + " ".join(f"{k}={v}" for k, v in result.items() if v is not None), flush=True)
+        return results
+
+def _compare(current: Dict[str, Any], previous: Dict[str, Any]) -> None:
+    print(f"\ncompared with {previous.get('name')} ({previous.get('created_at')})")
+    lower_is_better = ("p50_ms", "p99_ms", "ttft_p50_ms", "ttft_p99_ms", "backend_cpu_s", "backend_rss_peak_mb")
+    for key, result in current["results"].items():
+        before = previous.get("results", {}).get(key)
+        if not before:
+            continue
+        parts = []
+        for metric in ("throughput_rps",) + lower_is_better:
+            a, b = before.get(metric), result.get(metric)
+            if a and b is not None:
+                change = (b - a) / a * 100
+                better = change < 0 if metric in lower_is_better else change > 0
+                parts.append(f"{metric} {a} -> {b} ({change:+.1f}%{'' if abs(change) < 1 else ' better' if better else ' worse'})")
+        print(f"  {key}: " + "; ".join(parts))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Viper backend benchmark")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--sessions", type=int, default=16, help="sessions shared by the chat/read scenarios")
+    parser.add_argument("--history", default="0,50", help="comma separated pre-seeded history lengths")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock upstream latency before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--output-tokens", type=int, default=64)
+    parser.add_argument("--baseline-dir", default=str(BASELINE_DIR))
+    parser.add_argument("--save", default=None, help="baseline name to write (default: timestamp)")
+    parser.add_argument("--compare", default="latest", help="baseline name to compare against ('' to skip)")
+    args = parser.parse_args()
+    args.scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.history = [int(h) for h in args.history.split(",") if h]
+
+    mock_port, backend_port = _free_port(), _free_port()
+    workdir = tempfile.mkdtemp(prefix="viper-bench-")
+    env = {**os.environ, "VIPER_DB_PATH": os.path.join(workdir, "bench.sqlite3")}
+    mock = subprocess.Popen(
+        [
+            sys.executable, "-m", "backend.bench.mock_upstream",
+            "--port", str(mock_port),
+            "--latency", str(args.latency),
+            "--tokens-per-second", str(args.tokens_per_second),
+            "--chunk-tokens", str(args.chunk_tokens),
+            "--output-tokens", str(args.output_tokens),
+        ],
+        cwd=ROOT,
+    )
+    backend = subprocess.Popen([sys.executable, "-m", "backend.entrypoint", "--port", str(backend_port)], cwd=ROOT, env=env)
+    try:
+        mock_url, backend_url = f"http://127.0.0.1:{mock_port}", f"http://127.0.0.1:{backend_port}"
+        _wait_http(mock_url + "/stats", mock)
+        _wait_http(backend_url + "/health", backend)
+        results = asyncio.run(_drive(args, backend_url, mock_url, ProcessProbe(backend.pid)))
+    finally:
+        for proc in (backend, mock):
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    now = datetime.now()
+    report = {
+        "name": args.save or now.strftime("%Y%m%d-%H%M%S"),
+        "created_at": now.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("save", "compare", "baseline_dir")},
+        "results": results,
+    }
+    baseline_dir = Path(args.baseline_dir)
+    previous_path = baseline_dir / f"{args.compare}.json" if args.compare else None
+    if previous_path is not None and previous_path.exists():
+        _compare(report, json.loads(previous_path.read_text(encoding="utf-8")))
+    baseline_dir.mkdir(parents=True, exist_ok=True)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    (baseline_dir / f"{report['name']}.json").write_text(text, encoding="utf-8")
+    (baseline_dir / "latest.json").write_text(text, encoding="utf-8")
+    print(f"\nsaved {baseline_dir / (report['name'] + '.json')}")
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,78 @@
+import time
+
+STARTED = time.perf_counter()
+
 import argparse
+import json
 import os
 import sys
 from pathlib import Path
+from typing import Any, Dict
+
+# Only the standard library is imported up front. The app reads VIPER_DB_PATH at
+# import time, so it must not be imported before --db-path has been applied.
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 1)
+
+def measure_startup(host: str, output: str) -> None:
+    # Boots the app the same way as a normal start, issues one GET /health and
+    # reports where the time went, then exits.
+    timings: Dict[str, Any] = {"entrypoint_ms": _ms(time.perf_counter() - STARTED)}
+    import socket
+    import threading
+    import urllib.request
 
-import uvicorn
-from backend.app.main import app
+    t = time.perf_counter()
+    import uvicorn
+    timings["import_uvicorn_ms"] = _ms(time.perf_counter() - t)
+    t = time.perf_counter()
+    from backend.app.main import app
+    timings["import_app_ms"] = _ms(time.perf_counter() - t)
+    t = time.perf_counter()
+    from backend.app.db import db_session
+    from backend.app.migrations import migrate
+    with db_session() as db:
+        timings["migrations_applied"] = migrate(db)
+    timings["db_init_ms"] = _ms(time.perf_counter() - t)
+
+    with socket.socket() as s:
+        s.bind((host, 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    t = time.perf_counter()
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started and thread.is_alive():
+        time.sleep(0.001)
+    timings["server_start_ms"] = _ms(time.perf_counter() - t)
+    t = time.perf_counter()
+    with urllib.request.urlopen(f"http://{host}:{port}/health", timeout=30) as resp:
+        resp.read()
+    timings["first_request_ms"] = _ms(time.perf_counter() - t)
+    timings["total_ms"] = _ms(time.perf_counter() - STARTED)
+    server.should_exit = True
+    thread.join(10)
+
+    text = json.dumps(timings)
+    if output == "-":
+        print(text, flush=True)
+    else:
+        Path(output).write_text(text + "\n", encoding="utf-8")
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="127.0.0.1")
     parser.add_argument("--port", type=int, default=8000)
     parser.add_argument("--db-path", default=None)
+    parser.add_argument(
+        "--measure-startup",
+        nargs="?",
+        const="-",
+        default=None,
+        metavar="FILE",
+        help="report import, DB init and first request timings as JSON (to stdout, or FILE) and exit",
+    )
     args = parser.parse_args()
 
     if args.db_path:
@@ -23,6 +85,13 @@ def main() -> None:
     if sys.stderr is None:
         sys.stderr = open(os.devnull, "w")
 
+    if args.measure_startup:
+        measure_startup(args.host, args.measure_startup)
+        return
+
+    import uvicorn
+    from backend.app.main import app
+
     uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Iterator
+import pytest
+
+# The app reads VIPER_DB_PATH at import time, so point it somewhere disposable
+# before any test module imports backend.app.
+os.environ.setdefault("VIPER_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="viper-tests-"), "viper.sqlite3"))
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from backend.app import db  # noqa: E402
+
+@pytest.fixture
+def anyio_backend() -> str:
+    # The scheduler and stream buffers are built on asyncio primitives.
+    return "asyncio"
+
+@pytest.fixture
+def db_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    # A fresh database file per test, reached through the regular pool.
+    path = tmp_path / "viper.sqlite3"
+    db.close_pool()
+    monkeypatch.setattr(db, "DB_PATH", path)
+    yield path
+    db.close_pool()
@@ -0,0 +1,125 @@
+import sqlite3
+from pathlib import Path
+from typing import List
+import pytest
+
+from backend.app import migrations
+from backend.app.db import backfill_fts, db_session, get_meta
+from backend.app.migrations import SCHEMA_VERSION, migrate
+
+def _columns(db: sqlite3.Connection, table: str) -> List[str]:
+    return [r["name"] for r in db.execute(f"PRAGMA table_info({table});").fetchall()]
+
+def _version(db: sqlite3.Connection) -> int:
+    return db.execute("PRAGMA user_version;").fetchone()[0]
+
+def _search(db: sqlite3.Connection, text: str) -> List[int]:
+    rows = db.execute("SELECT rowid FROM chat_messages_fts WHERE chat_messages_fts MATCH ? ORDER BY rowid;", (f'"{text}"',)).fetchall()
+    return [r[0] for r in rows]
+
+def _legacy(path: Path) -> None:
+    # Schema as shipped before versioning: misspelled update_at, no message metadata.
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE api_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            base_url TEXT NOT NULL,
+            api_key TEXT,
+            model TEXT NOT NULL,
+            extra_headers_json TEXT NOT NULL DEFAULT '{}',
+            created_at TEXT NOT NULL,
+            update_at TEXT NOT NULL
+        );
+        CREATE TABLE chat_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            api_config_id INTEGER,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE TABLE chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        INSERT INTO api_configs(name, kind, base_url, model, created_at, update_at) VALUES ('old', 'openai_compatible', 'http://x', 'm', 't', 't');
+        INSERT INTO chat_sessions(title, created_at, updated_at) VALUES ('a', 't', 't'), ('b', 't', 't');
+        INSERT INTO chat_messages(session_id, role, content, created_at) VALUES
+            (1, 'user', 'hello legacy world', 't'),
+            (1, 'assistant', 'hi there', 't'),
+            (2, 'user', 'second session', 't'),
+            (1, 'user', 'follow up', 't');
+        """
+    )
+    conn.commit()
+    conn.close()
+
+def test_empty_database_migrates_to_current(db_path: Path) -> None:
+    with db_session() as db:
+        assert migrate(db) == SCHEMA_VERSION
+        assert _version(db) == SCHEMA_VERSION
+        assert migrate(db) == 0
+        assert "parent_id" in _columns(db, "chat_messages")
+        assert "head_message_id" in _columns(db, "chat_sessions")
+        assert get_meta(db, "fts_backfill_end") is None
+
+def test_legacy_database_is_upgraded_in_place(db_path: Path) -> None:
+    _legacy(db_path)
+    with db_session() as db:
+        assert migrate(db) == SCHEMA_VERSION
+        cols = _columns(db, "api_configs")
+        assert "updated_at" in cols and "update_at" not in cols
+        assert {"pool", "max_concurrency", "context_strategy"} <= set(cols)
+        assert db.execute("SELECT updated_at FROM api_configs;").fetchone()[0] == "t"
+        # Existing history becomes one chain per session with the last message as head.
+        parents = {r["id"]: r["parent_id"] for r in db.execute("SELECT id, parent_id FROM chat_messages;")}
+        assert parents == {1: None, 2: 1, 3: None, 4: 2}
+        heads = {r["id"]: r["head_message_id"] for r in db.execute("SELECT id, head_message_id FROM chat_sessions;")}
+        assert heads == {1: 4, 2: 3}
+        assert get_meta(db, "fts_backfill_upto") == "0"
+        assert get_meta(db, "fts_backfill_end") == "4"
+    backfill_fts()
+    with db_session() as db:
+        assert get_meta(db, "fts_backfill_end") is None
+        assert _search(db, "legacy") == [1]
+        # New rows are indexed by the triggers and extend the head.
+        db.execute("INSERT INTO chat_messages(session_id, role, content, parent_id, created_at) VALUES (1, 'assistant', 'fresh legacy reply', 4, 't');")
+        assert _search(db, "legacy") == [1, 5]
+        assert db.execute("SELECT head_message_id FROM chat_sessions WHERE id = 1;").fetchone()[0] == 5
+
+def test_partially_migrated_database_resumes(db_path: Path) -> None:
+    with db_session() as db:
+        db.execute("BEGIN IMMEDIATE;")
+        for step in migrations.MIGRATIONS[:3]:
+            step(db)
+        db.execute("PRAGMA user_version = 3;")
+        db.commit()
+        assert migrate(db) == SCHEMA_VERSION - 3
+        assert _version(db) == SCHEMA_VERSION
+        db.execute("INSERT INTO chat_sessions(title, created_at, updated_at) VALUES ('s', 't', 't');")
+        db.execute("INSERT INTO chat_messages(session_id, role, content, created_at) VALUES (1, 'user', 'indexed once', 't');")
+        assert _search(db, "indexed") == [1]
+
+def test_failed_step_rolls_back(db_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    def broken(db: sqlite3.Connection) -> None:
+        db.execute("CREATE TABLE half_done (id INTEGER);")
+        raise sqlite3.OperationalError("boom")
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS + [broken])
+    monkeypatch.setattr(migrations, "SCHEMA_VERSION", SCHEMA_VERSION + 1)
+    with db_session() as db:
+        with pytest.raises(sqlite3.OperationalError):
+            migrate(db)
+        assert _version(db) == SCHEMA_VERSION
+        assert db.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done';").fetchone() is None
+
+def test_newer_database_is_refused(db_path: Path) -> None:
+    with db_session() as db:
+        db.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1};")
+        with pytest.raises(RuntimeError):
+            migrate(db)
@@ -0,0 +1,134 @@
+import asyncio
+from typing import List
+import pytest
+from fastapi import HTTPException
+
+from backend.app import scheduler
+from backend.app.scheduler import ConfigLimiter, Slot, parse_retry_after
+
+pytestmark = pytest.mark.anyio
+
+def _limiter(max_concurrency: int = 0, tokens_per_minute: int = 0) -> ConfigLimiter:
+    limiter = ConfigLimiter(1)
+    limiter.configure({"max_concurrency": max_concurrency, "tokens_per_minute": tokens_per_minute})
+    return limiter
+
+async def _settle() -> None:
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+async def test_concurrency_limit_admits_on_release() -> None:
+    limiter = _limiter(max_concurrency=1)
+    first = await limiter.acquire(1)
+    second = asyncio.create_task(limiter.acquire(1))
+    await _settle()
+    assert not second.done()
+    assert limiter.stats()["queue_depth"] == 1
+    first.release()
+    slot = await asyncio.wait_for(second, 1)
+    assert limiter.in_flight == 1 and limiter.waiting == 0
+    slot.release()
+    assert limiter.in_flight == 0
+
+async def test_interactive_runs_before_batch() -> None:
+    limiter = _limiter(max_concurrency=1)
+    holder = await limiter.acquire(1)
+    order: List[str] = []
+
+    async def wait(priority: str) -> Slot:
+        slot = await limiter.acquire(1, priority)
+        order.append(priority)
+        return slot
+
+    batch = asyncio.create_task(wait("batch"))
+    await _settle()
+    interactive = asyncio.create_task(wait("interactive"))
+    await _settle()
+    holder.release()
+    (await asyncio.wait_for(interactive, 1)).release()
+    (await asyncio.wait_for(batch, 1)).release()
+    assert order == ["interactive", "batch"]
+
+async def test_release_is_idempotent() -> None:
+    limiter = _limiter(max_concurrency=2)
+    calls: List[int] = []
+    slot = await limiter.acquire(1)
+    slot.on_release.append(lambda: calls.append(1))
+    slot.release()
+    slot.release()
+    assert limiter.in_flight == 0
+    assert calls == [1]
+
+async def test_full_queue_is_rejected(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(scheduler, "SCHEDULER_MAX_QUEUE", 1)
+    limiter = _limiter(max_concurrency=1)
+    holder = await limiter.acquire(1)
+    waiter = asyncio.create_task(limiter.acquire(1))
+    await _settle()
+    with pytest.raises(HTTPException) as exc:
+        await limiter.acquire(1)
+    assert exc.value.status_code == 429
+    assert limiter.rejected == 1
+    holder.release()
+    (await asyncio.wait_for(waiter, 1)).release()
+    assert limiter.in_flight == 0
+
+async def test_cancelled_waiter_frees_its_place() -> None:
+    limiter = _limiter(max_concurrency=1)
+    holder = await limiter.acquire(1)
+    waiter = asyncio.create_task(limiter.acquire(1))
+    await _settle()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.waiting == 0
+    holder.release()
+    # The cancelled entry is skipped rather than handed the permit.
+    assert limiter.in_flight == 0
+    (await limiter.acquire(1)).release()
+    assert limiter.in_flight == 0
+
+async def test_tokens_per_minute_waits_for_the_window(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(scheduler, "TPM_WINDOW", 0.1)
+    limiter = _limiter(tokens_per_minute=100)
+    (await limiter.acquire(80)).release()
+    second = asyncio.create_task(limiter.acquire(50))
+    await _settle()
+    assert not second.done()
+    assert limiter.stats()["window_tokens"] == 80
+    # Nothing is released in between; the scheduled wake-up admits it once the window slides.
+    (await asyncio.wait_for(second, 1)).release()
+    # A request larger than the whole budget still runs once the window is empty.
+    await asyncio.sleep(0.15)
+    (await asyncio.wait_for(limiter.acquire(500), 1)).release()
+
+async def test_rate_limit_pauses_admission() -> None:
+    limiter = _limiter()
+    limiter.rate_limit(0.05)
+    waiter = asyncio.create_task(limiter.acquire(1))
+    await _settle()
+    assert not waiter.done()
+    (await asyncio.wait_for(waiter, 1)).release()
+    assert limiter.rate_limited == 1
+
+async def test_shorter_pause_reschedules_the_wake_up() -> None:
+    limiter = _limiter(tokens_per_minute=10)
+    (await limiter.acquire(10)).release()
+    waiter = asyncio.create_task(limiter.acquire(5))
+    await _settle()
+    assert limiter._wake is not None
+    later = limiter._wake_at
+    # A Retry-After shorter than the TPM wait must not be stuck behind it.
+    limiter._window.clear()
+    limiter._window_tokens = 0
+    limiter.rate_limit(0.02)
+    limiter._dispatch()
+    assert limiter._wake_at < later
+    (await asyncio.wait_for(waiter, 1)).release()
+
+def test_parse_retry_after() -> None:
+    assert parse_retry_after("2.5") == 2.5
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after(None) == scheduler.DEFAULT_RETRY_AFTER
+    assert parse_retry_after("not a date") == scheduler.DEFAULT_RETRY_AFTER
+    assert parse_retry_after("Mon, 01 Jan 2001 00:00:00 GMT") == 0.0
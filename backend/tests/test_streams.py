@@ -0,0 +1,180 @@
+import asyncio
+import json
+from typing import Awaitable, Callable, List, Optional
+import pytest
+
+from backend.app import streams
+from backend.app.streams import Generation, start_generation
+
+pytestmark = pytest.mark.anyio
+
+def _event(text: str) -> bytes:
+    return b"data: %s\n\n" % json.dumps({"choices": [{"delta": {"content": text}}]}).encode()
+
+async def _collect(gen: Generation, last_event_id: Optional[int] = None, session_id: Optional[int] = None) -> List[bytes]:
+    return [frame async for frame in gen.subscribe(last_event_id, session_id)]
+
+async def test_events_are_split_on_boundaries_and_numbered() -> None:
+    gen = Generation(1)
+    gen.publish(b"data: a\n\ndata: ")
+    gen.publish(b"b\n\n")
+    gen.publish(b"data: c")
+    gen.finish("complete")
+    assert await _collect(gen) == [
+        b"data: a\n\nid: 0\n\n",
+        b"data: b\n\nid: 1\n\n",
+        b"data: c\n\nid: 2\n\n",
+    ]
+
+async def test_resume_replays_after_last_event_id() -> None:
+    gen = Generation(1)
+    for word in ("a", "b", "c"):
+        gen.publish(_event(word))
+    gen.finish("complete")
+    frames = await _collect(gen, last_event_id=0)
+    assert frames == [_event("b") + b"id: 1\n\n", _event("c") + b"id: 2\n\n"]
+    assert gen.replayable(0)
+    assert await _collect(gen, last_event_id=2) == []
+
+async def test_lagged_subscriber_gets_an_error_event(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(streams, "STREAM_BUFFER_EVENTS", 2)
+    gen = Generation(1)
+    for word in "abcde":
+        gen.publish(_event(word))
+    gen.finish("complete")
+    assert not gen.replayable(0)
+    frames = await _collect(gen, last_event_id=0)
+    assert len(frames) == 1 and frames[0].startswith(b"event: error\n")
+    assert json.loads(frames[0].split(b"data: ", 1)[1])["status"] == "lagged"
+
+async def test_subscriber_follows_the_live_tail() -> None:
+    release = asyncio.Event()
+
+    async def produce(gen: Generation) -> None:
+        gen.publish(_event("a"))
+        await release.wait()
+        gen.publish(_event("b"))
+        gen.finish("complete")
+
+    gen = start_generation(101, produce)
+    first = asyncio.create_task(_collect(gen))
+    await asyncio.sleep(0.01)
+    # A second tab attaching mid-stream sees the same events.
+    second = asyncio.create_task(_collect(gen))
+    await asyncio.sleep(0.01)
+    assert gen.subscribers == 2
+    release.set()
+    assert await first == await second
+    assert len(await first) == 2
+    assert gen.status == "complete"
+    assert streams.get_generation(gen.id) is gen
+
+async def test_producer_error_ends_with_an_error_event() -> None:
+    async def produce(gen: Generation) -> None:
+        gen.publish(_event("a"))
+        raise ValueError("upstream went away")
+
+    gen = start_generation(102, produce)
+    frames = await asyncio.wait_for(_collect(gen), 1)
+    assert gen.status == "error"
+    assert b"upstream went away" in frames[-1]
+
+def _running(produced: asyncio.Event, cleaned: List[str], name: str = "producer") -> Callable[[Generation], Awaitable[None]]:
+    async def produce(gen: Generation) -> None:
+        try:
+            gen.publish(_event("a"))
+            produced.set()
+            await asyncio.sleep(30)
+        finally:
+            with streams.anyio.CancelScope(shield=True):
+                # Cleanup that awaits must survive a repeated cancel.
+                await asyncio.sleep(0.05)
+                cleaned.append(name)
+    return produce
+
+async def test_cancel_is_one_shot_and_cleanup_completes() -> None:
+    produced = asyncio.Event()
+    cleaned: List[str] = []
+    gen = start_generation(201, _running(produced, cleaned))
+    await produced.wait()
+    assert streams.cancel_generations(201) == 1
+    assert not gen.cancel()
+    assert streams.cancel_generations(201) == 0
+    await asyncio.wait_for(gen.task, 1)
+    assert cleaned == ["producer"]
+    assert gen.status == "truncated"
+    assert streams.active_generation_count() == 0
+
+async def test_cancel_before_the_producer_starts() -> None:
+    produced = asyncio.Event()
+    cleaned: List[str] = []
+    gen = start_generation(202, _running(produced, cleaned))
+    assert gen.cancel()
+    await asyncio.wait_for(gen.task, 1)
+    # The cancel lands at the producer's first await; its cleanup still runs.
+    assert cleaned == ["producer"]
+    assert gen.status == "truncated"
+    assert len(await _collect(gen)) == 1
+
+async def test_finished_generation_is_not_cancelled() -> None:
+    async def produce(gen: Generation) -> None:
+        gen.finish("complete")
+
+    gen = start_generation(203, produce)
+    await gen.task
+    assert not gen.cancel()
+    assert streams.cancel_generations(203) == 0
+
+async def test_abandoned_generation_is_cancelled_after_grace(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(streams, "STREAM_RESUME_GRACE", 0.05)
+    produced = asyncio.Event()
+    cleaned: List[str] = []
+    gen = start_generation(204, _running(produced, cleaned))
+    first = asyncio.create_task(_collect(gen))
+    await produced.wait()
+    await asyncio.sleep(0)
+    first.cancel()
+    # A reconnect within the grace period keeps it alive.
+    resumed = asyncio.create_task(_collect(gen, last_event_id=0))
+    await asyncio.sleep(0.1)
+    assert gen.status == "running" and gen.subscribers == 1
+    resumed.cancel()
+    await asyncio.wait_for(gen.task, 1)
+    assert gen.status == "truncated" and cleaned == ["producer"]
+
+async def test_cancelling_a_follower_detaches_it() -> None:
+    produced = asyncio.Event()
+    cleaned: List[str] = []
+    gen = start_generation(301, _running(produced, cleaned))
+    streams.attach_generation(gen, 302)
+    detached: List[int] = []
+    gen.on_detach.append(detached.append)
+    await produced.wait()
+    follower = asyncio.create_task(_collect(gen, session_id=302))
+    leader = asyncio.create_task(_collect(gen, session_id=301))
+    await asyncio.sleep(0.01)
+    assert streams.active_generation_count() == 1
+    assert streams.cancel_generations(302) == 1
+    # The follower's response ends; the shared upstream keeps going for the leader.
+    assert len(await asyncio.wait_for(follower, 1)) == 1
+    assert detached == [302]
+    assert gen.status == "running" and not leader.done()
+    assert streams.cancel_generations(302) == 0
+    assert streams.cancel_generations(301) == 1
+    await asyncio.wait_for(gen.task, 1)
+    assert len(await leader) == 1
+    assert gen.status == "truncated" and cleaned == ["producer"]
+    assert streams.active_generation_count() == 0
+
+async def test_leader_cancel_keeps_followers_running() -> None:
+    produced = asyncio.Event()
+    cleaned: List[str] = []
+    gen = start_generation(303, _running(produced, cleaned))
+    streams.attach_generation(gen, 304)
+    await produced.wait()
+    assert streams.cancel_generations(303) == 1
+    await asyncio.sleep(0.01)
+    assert gen.status == "running" and gen.sessions == {304}
+    assert streams.cancel_generations(304) == 1
+    await asyncio.wait_for(gen.task, 1)
+    assert cleaned == ["producer"]